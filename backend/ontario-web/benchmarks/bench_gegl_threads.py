@@ -0,0 +1,47 @@
+# GNU AGPL v3 License
+# Sweeps the number of GEGL threads against the time taken to render a
+# blurred and color adjusted image, to size ONTARIO_GEGL_THREADS for each
+# server worker. Needs GEGL.
+#
+# Run from backend/ontario-web with: python benchmarks/bench_gegl_threads.py
+
+import os
+import sys
+import timeit
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(__file__), ".."))
+
+from ontario_web import ontario  # noqa
+
+REPEATS = 5
+
+IMAGE = path.join(
+    path.dirname(__file__), "..", "..", "ontario", "tests", "assets",
+    "test-image.png")
+
+
+def render():
+    # Decode every time, so each run does the same work
+    builder = ontario.ImageBuilder(ontario.ImageContext())
+    builder.load_from_file(IMAGE, cache=False)
+    builder.gaussian_blur(8, 8)
+    builder.brightness_contrast(0.1, 1.2)
+    builder.to_buffer()
+
+
+def main():
+    thread_counts = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+    baseline = None
+    for threads in thread_counts:
+        ontario.configure(threads=threads)
+        elapsed = min(timeit.repeat(render, number=REPEATS, repeat=3))
+        per_render = elapsed / REPEATS
+        baseline = baseline or per_render
+        print(f"{threads:3} threads {per_render * 1e3:8.2f} ms per render"
+              f"   {baseline / per_render:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# GNU AGPL v3 License
+# Measures the memory used by a large deserialized pipeline.
+#
+# Run from backend/ontario-web with: python benchmarks/bench_node_memory.py
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(__file__), ".."))
+
+from ontario_web import nodes  # noqa
+
+NODE_COUNT = 10000
+
+
+def make_template_table() -> nodes.TemplateTable:
+    """
+    A minimal table with a source, a one-input filter and a sink.
+    """
+
+    table = nodes.TemplateTable()
+    for name in ("Src", "Filter", "Out"):
+        inputs = [] if name == "Src" else [nodes.LinkTemplate(None, 0, None)]
+        table.addTemplate(name, nodes.NodeTemplate(
+            lambda args, meta: [0],
+            inputs,
+            [nodes.LinkTemplate(None, 0, None)],
+            None,
+        ))
+    return table
+
+
+def make_serialized_pipeline(count: int) -> nodes.SerializedPipeline:
+    """
+    A chain of `count` nodes from a source to an output.
+    """
+
+    serialized = {"nodes": [], "links": [], "output": count}
+    for id in range(1, count + 1):
+        template = "Filter"
+        if id == 1:
+            template = "Src"
+        elif id == count:
+            template = "Out"
+        serialized["nodes"].append({"id": id, "template": template})
+        if id > 1:
+            serialized["links"].append({
+                "from": id - 1, "to": id, "fromIndex": 0, "toIndex": 0
+            })
+    return serialized
+
+
+def main():
+    table = make_template_table()
+    serialized = make_serialized_pipeline(NODE_COUNT)
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    pipeline = nodes.deserializePipeline(serialized, table)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(pipeline.getNodes()) == NODE_COUNT
+    print(f"nodes:           {NODE_COUNT}")
+    print(f"total bytes:     {size}")
+    print(f"bytes per node:  {size / NODE_COUNT:.1f}")
+    print(f"deserialize:     {elapsed * 1000:.1f} ms (traced)")
+
+
+if __name__ == "__main__":
+    main()
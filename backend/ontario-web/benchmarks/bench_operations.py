@@ -0,0 +1,130 @@
+# GNU AGPL v3 License
+# Compares ontario's GEGL implementations of flip, color balance, curves and
+# perspective transforms with chunked NumPy kernels doing the same work, to
+# pick the faster backend for each operation. Needs GEGL and NumPy.
+#
+# Run from backend/ontario-web with: python benchmarks/bench_operations.py
+
+import sys
+import timeit
+
+from os import path
+
+import numpy
+
+sys.path.insert(0, path.join(path.dirname(__file__), ".."))
+
+from ontario_web.ontario import ImageBuilder, ImageContext  # noqa
+
+REPEATS = 5
+
+# Rows handled per NumPy chunk, a band of GEGL tiles.
+CHUNK = 128
+
+IMAGE = path.join(
+    path.dirname(__file__), "..", "..", "ontario", "tests", "assets",
+    "test-image.png")
+
+CURVE = "0,0 0.25,0.15 0.75,0.85 1,1"
+
+
+def source():
+    builder = ImageBuilder(ImageContext())
+    builder.load_from_file(IMAGE)
+    return builder
+
+
+def gegl(operation):
+    def run():
+        builder = source()
+        operation(builder)
+        builder.to_buffer()
+    return run
+
+
+def in_chunks(pixels, kernel):
+    out = numpy.empty_like(pixels)
+    for start in range(0, pixels.shape[0], CHUNK):
+        out[start:start + CHUNK] = kernel(pixels[start:start + CHUNK])
+    return out
+
+
+def numpy_flip(pixels):
+    return in_chunks(pixels, lambda band: band[:, ::-1])
+
+
+def numpy_color_balance(pixels):
+    gains = numpy.array([1.5, 1.0, 0.5, 1.0], dtype=numpy.float32)
+    return in_chunks(pixels, lambda band: band * gains)
+
+
+def numpy_curves(pixels):
+    xs, ys = zip(*(map(float, p.split(",")) for p in CURVE.split()))
+    table = numpy.interp(
+        numpy.linspace(0, 1, 4096), xs, ys).astype(numpy.float32)
+
+    def kernel(band):
+        out = band.copy()
+        indices = numpy.clip(band[..., :3], 0, 1) * 4095
+        out[..., :3] = table[numpy.rint(indices).astype(numpy.intp)]
+        return out
+    return in_chunks(pixels, kernel)
+
+
+def numpy_perspective(pixels):
+    # Inverse map every output pixel, sampling the nearest source pixel.
+    height, width = pixels.shape[:2]
+    inverse = numpy.linalg.inv(numpy.array(
+        [[0.9, 0.05, 10], [0.0, 1.0, 0], [0.0, 0.0001, 1]]))
+    xs = numpy.arange(width)
+
+    def kernel(start, band):
+        ys = numpy.arange(start, start + band.shape[0])[:, numpy.newaxis]
+        w = inverse[2, 0] * xs + inverse[2, 1] * ys + inverse[2, 2]
+        u = (inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]) / w
+        v = (inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]) / w
+        u = numpy.clip(u.astype(numpy.intp), 0, width - 1)
+        v = numpy.clip(v.astype(numpy.intp), 0, height - 1)
+        return pixels[v, u]
+
+    out = numpy.empty_like(pixels)
+    for start in range(0, height, CHUNK):
+        out[start:start + CHUNK] = kernel(start, out[start:start + CHUNK])
+    return out
+
+
+def with_numpy(kernel):
+    def run():
+        builder = source()
+        pixels = builder.to_numpy()
+        ImageBuilder(ImageContext()).load_from_numpy(
+            kernel(pixels)).to_buffer()
+    return run
+
+
+def main():
+    _, _, width, height = source().extent()
+    operations = (
+        ("flip",
+         gegl(lambda b: b.flip(True, False)), with_numpy(numpy_flip)),
+        ("color balance",
+         gegl(lambda b: b.color_balance(0.5, 0, -0.5)),
+         with_numpy(numpy_color_balance)),
+        ("curves",
+         gegl(lambda b: b.curves(CURVE)), with_numpy(numpy_curves)),
+        ("perspective",
+         gegl(lambda b: b.perspective_transform(
+             10, 0, width - 10, 0, width, height, 0, height)),
+         with_numpy(numpy_perspective)),
+    )
+
+    print(f"{width}x{height} image")
+    for name, gegl_run, numpy_run in operations:
+        gegl_time = min(timeit.repeat(gegl_run, number=REPEATS, repeat=3))
+        numpy_time = min(timeit.repeat(numpy_run, number=REPEATS, repeat=3))
+        print(f"{name:14} gegl {gegl_time / REPEATS * 1e3:8.2f} ms"
+              f"   numpy {numpy_time / REPEATS * 1e3:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# GNU AGPL v3 License
+# Measures the per-request cost of setting up a pipeline, comparing a
+# template table rebuilt for every request with the shared frozen table.
+#
+# Run from backend/ontario-web with: python benchmarks/bench_template_table.py
+
+import sys
+import timeit
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(__file__), ".."))
+
+from ontario_web import nodes, processor  # noqa
+
+REPEATS = 2000
+
+PIPELINE = {
+    "nodes": [
+        {"id": 0, "template": "ImgSrc", "values": {"image": 0}},
+        {"id": 1, "template": "ImgSrc", "values": {"image": 1}},
+        {"id": 2, "template": "GaussBlur",
+         "values": {"std_dev_x": 2.0, "std_dev_y": 2.0}},
+        {"id": 3, "template": "BrightCont",
+         "values": {"brightness": 0.1, "contrast": 1.2}},
+        {"id": 4, "template": "CompOver"},
+        {"id": 5, "template": "ImgOut"},
+    ],
+    "links": [
+        {"id": 6, "from": 0, "to": 2, "fromIndex": 0, "toIndex": 0},
+        {"id": 7, "from": 1, "to": 3, "fromIndex": 0, "toIndex": 0},
+        {"id": 8, "from": 2, "to": 4, "fromIndex": 0, "toIndex": 0},
+        {"id": 9, "from": 3, "to": 4, "fromIndex": 0, "toIndex": 1},
+        {"id": 10, "from": 4, "to": 5, "fromIndex": 0, "toIndex": 0},
+    ],
+    "output": 5,
+}
+
+
+def rebuilt_table():
+    nodes.deserializePipeline(PIPELINE, processor.make_template_table())
+
+
+def shared_table():
+    nodes.deserializePipeline(PIPELINE, processor.get_template_table())
+
+
+def main():
+    for name, func in (("rebuilt table", rebuilt_table),
+                       ("shared table", shared_table)):
+        elapsed = min(timeit.repeat(func, number=REPEATS, repeat=5))
+        print(f"{name:14} {elapsed / REPEATS * 1e6:8.1f} us per request")
+
+
+if __name__ == "__main__":
+    main()
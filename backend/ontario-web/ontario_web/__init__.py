@@ -1,6 +1,7 @@
 # GNU AGPLv3 License
 # Written by John Nunley
 
+import io
 import os
 from os import path as os_path
 import tempfile
@@ -8,14 +9,18 @@ import psycopg2
 
 from . import db
 from . import image_manager
+from . import jobs
+from . import ontario
 from . import processor
+from . import render_cache
+from . import render_pool
 from . import save_and_load
 
-from flask import Flask, request, send_file, session
+from flask import Flask, Response, request, send_file, session
 from werkzeug.security import check_password_hash, generate_password_hash
 
 import atexit
-import random
+import json
 
 from dotenv import load_dotenv
 
@@ -88,6 +93,75 @@ def create_app(test_config=None):
         id="image_manager_clean_up",
     )
 
+    # Keep rendered outputs next to the images, so identical pipelines
+    # are only rendered once
+    renders = render_cache.RenderCache(
+        os_path.join(im.root(), "render_cache"),
+        int(env_or_else("ONTARIO_RENDER_CACHE_SIZE", str(256 * 1024 * 1024))),
+    )
+
+    # Render in a pool of worker processes, so renders don't block the
+    # request workers or inflate their memory
+    # Each worker is replaced after a number of renders, and renders
+    # estimated to need more memory than the limit are refused
+    # The address space limit of the workers is off by default, since it
+    # also counts reserved memory that is never used
+    render_max_tasks = int(env_or_else("ONTARIO_RENDER_MAX_TASKS", "100"))
+    render_memory_limit = int(env_or_else(
+        "ONTARIO_RENDER_MEMORY_LIMIT",
+        str(4 * 1024 * 1024 * 1024),
+    ))
+    render_address_limit = int(env_or_else(
+        "ONTARIO_RENDER_ADDRESS_LIMIT", "0"))
+
+    # Each worker keeps rendered intermediate images in memory, so pipelines
+    # that share a prefix only render it once, and keeps decoded source
+    # images, so they are not decoded again for every request
+    pool = render_pool.RenderPool(
+        int(env_or_else("ONTARIO_RENDER_WORKERS", "2")),
+        render_max_tasks,
+        render_memory_limit,
+        int(env_or_else(
+            "ONTARIO_INTERMEDIATE_CACHE_SIZE",
+            str(256 * 1024 * 1024),
+        )),
+        int(env_or_else(
+            "ONTARIO_SOURCE_CACHE_SIZE",
+            str(256 * 1024 * 1024),
+        )),
+        render_address_limit,
+    )
+    atexit.register(pool.shutdown)
+    app.extensions["render_pool"] = pool
+
+    # Render long jobs on a separate pool, so they don't hold up interactive
+    # renders
+    job_queue = jobs.JobQueue(
+        os_path.join(im.root(), "jobs"),
+        int(env_or_else("ONTARIO_JOB_WORKERS", "2")),
+        render_max_tasks,
+        render_memory_limit,
+        render_address_limit,
+    )
+    atexit.register(job_queue.shutdown)
+    app.extensions["job_queue"] = job_queue
+
+    # Pick up jobs queued by other processes or left over by a previous run,
+    # and remove finished jobs after a day
+    scheduler.add_job(
+        func=job_queue.dispatch,
+        trigger="interval",
+        seconds=5,
+        id="job_queue_dispatch",
+    )
+    scheduler.add_job(
+        func=lambda: job_queue.clean_up(
+            float(env_or_else("ONTARIO_JOB_MAX_AGE", str(24 * 60 * 60)))),
+        trigger="interval",
+        hours=1,
+        id="job_queue_clean_up",
+    )
+
     # Create a directory to store projects in
     instance_path = app.config["INSTANCE_PATH"]
     if not os_path.exists(instance_path):
@@ -109,7 +183,7 @@ def create_app(test_config=None):
         # Save the image to the disk
         with tempfile.TemporaryDirectory() as dir:
             ext = os_path.splitext(image.filename)[1]
-            p = os_path.join(dir, f"image.{ext}")
+            p = os_path.join(dir, f"image{ext}")
             with open(p, "wb") as file:
                 file.write(image.read())
             new_id = im.add_image(p)
@@ -117,19 +191,179 @@ def create_app(test_config=None):
 
     # For /api/process, take the body of the request and process it
     # as a JSON pipeline, using the "processor" module
+    # With ?profile=1, per-node timings are returned in the
+    # X-Ontario-Profile header as JSON
+    # Rendered images are sent as webp when GdkPixbuf, or GEGL through
+    # shared memory, can encode it, and as png otherwise; the Content-Type
+    # says which
+    output_format = "webp"
+    if "webp" not in ontario.encodable_formats():
+        output_format = "png"
+        app.logger.warning(
+            "No webp encoder is usable, so rendered images are sent as png.")
+
     @app.route("/api/process", methods=["POST"])
     def process():
         # The body of the request should be a JSON pipeline
         pipeline = request.get_json()
-        print("PIPELINE: ")
-        print(pipeline)
-        id = random.randint(0, 1000000000)
-        filename = f"/tmp/ontario/out{id}.webp"
-        processor.process(pipeline, im, filename)
-        print(filename)
+
+        profile = request.args.get("profile") == "1"
+
+        # An optional viewport limits rendering to the visible region
+        viewport = None
+        bounds = [request.args.get(k) for k in ("x", "y", "width", "height")]
+        if any(bound is not None for bound in bounds):
+            try:
+                viewport = tuple(int(bound) for bound in bounds)
+            except (TypeError, ValueError):
+                viewport = None
+            if viewport is None or viewport[2] <= 0 or viewport[3] <= 0:
+                return {
+                    "error": "Viewport needs integer x, y, width and height."
+                }, 400
+
+        # Previews render at a fraction of the full resolution
+        preview_scale = 1.0
+        if request.args.get("preview") is not None:
+            try:
+                preview_scale = float(request.args["preview"])
+            except ValueError:
+                preview_scale = 0.0
+            if not 0 < preview_scale <= 1:
+                return {
+                    "error": "Preview scale must be in (0, 1]."
+                }, 400
+
+        quality = request.args.get("quality", type=int)
+        if quality is not None and not 0 <= quality <= 100:
+            return {"error": "Quality must be between 0 and 100."}, 400
+
+        # Profiled renders bypass the render cache
+        report = None
+        try:
+            if profile:
+                data, report = pool.render_profiled(
+                    pipeline,
+                    im,
+                    viewport=viewport,
+                    preview_scale=preview_scale,
+                    format=output_format,
+                    quality=quality,
+                )
+            else:
+                data = pool.render(
+                    pipeline,
+                    im,
+                    cache=renders,
+                    viewport=viewport,
+                    preview_scale=preview_scale,
+                    format=output_format,
+                    quality=quality,
+                )
+        except render_pool.RenderTooLarge as e:
+            return {"error": str(e)}, 413
+        except render_pool.RenderCrashed as e:
+            return {"error": str(e)}, 503
 
         # The body of the response should be the output image
-        return send_file(filename)
+        response = send_file(
+            io.BytesIO(data), mimetype=f"image/{output_format}")
+        if report is not None:
+            response.headers["X-Ontario-Profile"] = json.dumps(report)
+        return response
+
+    # For /api/process_batch, apply one pipeline to many images
+    # The body of the request should be a JSON object with the pipeline,
+    # the ID of the ImgSrc node to bind and the image IDs to bind it to
+    # The rendered images are streamed back as a zip archive
+    batch_workers = int(env_or_else("ONTARIO_BATCH_WORKERS", "4"))
+
+    @app.route("/api/process_batch", methods=["POST"])
+    def process_batch():
+        body = request.get_json()
+        if not isinstance(body, dict) or not all(
+            key in body for key in ("pipeline", "source", "images")
+        ):
+            return {
+                "error": "Batch needs a pipeline, a source and images."
+            }, 400
+
+        image_ids = body["images"]
+        if not isinstance(image_ids, list) or not image_ids:
+            return {"error": "Images must be a non-empty list."}, 400
+        for image_id in image_ids:
+            try:
+                im.image_path_for_id(image_id)
+            except (KeyError, TypeError):
+                return {"error": f"Image {image_id} does not exist."}, 404
+        if len(set(image_ids)) != len(image_ids):
+            return {"error": "Images must not repeat."}, 400
+
+        try:
+            results = processor.process_batch(
+                body["pipeline"],
+                im,
+                body["source"],
+                image_ids,
+                workers=batch_workers,
+                format=output_format,
+                renderer=pool.render,
+                cache=renders,
+            )
+        except (KeyError, ValueError) as e:
+            return {"error": str(e)}, 400
+
+        # The response has started by the time a render fails, so failures
+        # are reported in the archive next to the images that worked
+        files = (
+            (f"{image_id}.{output_format}", data) if error is None
+            else (f"{image_id}.error.txt", error.encode())
+            for image_id, data, error in results
+        )
+        response = Response(
+            processor.stream_zip(files), mimetype="application/zip")
+        response.headers["Content-Disposition"] = (
+            "attachment; filename=batch.zip")
+        return response
+
+    # For /api/jobs, queue the JSON pipeline in the body of the request to
+    # be rendered in the background, returning the ID of the job
+    @app.route("/api/jobs", methods=["POST"])
+    def submit_job():
+        pipeline = request.get_json()
+
+        quality = request.args.get("quality", type=int)
+        if quality is not None and not 0 <= quality <= 100:
+            return {"error": "Quality must be between 0 and 100."}, 400
+
+        try:
+            job_id = job_queue.submit(
+                pipeline, im, format=output_format, quality=quality)
+        except KeyError as e:
+            return {"error": f"Image {e.args[0]} does not exist."}, 404
+        except render_pool.RenderTooLarge as e:
+            return {"error": str(e)}, 413
+        return {"id": job_id}, 202
+
+    # For /api/jobs/<id>, report the status and progress of a job
+    @app.route("/api/jobs/<job_id>", methods=["GET"])
+    def job_status(job_id):
+        status = job_queue.status(job_id)
+        if status is None:
+            return {"error": f"Job {job_id} does not exist."}, 404
+        return status
+
+    # For /api/jobs/<id>/result, send the image rendered by a finished job
+    @app.route("/api/jobs/<job_id>/result", methods=["GET"])
+    def job_result(job_id):
+        status = job_queue.status(job_id)
+        if status is None:
+            return {"error": f"Job {job_id} does not exist."}, 404
+        result = job_queue.result_path(job_id)
+        if result is None:
+            return {"error": f"Job {job_id} is {status['status']}."}, 409
+        result_path, format = result
+        return send_file(result_path, mimetype=f"image/{format}")
 
     # For /api/register, take the username, realname and password
     # from the body of the request and save them to the database
@@ -5,6 +5,7 @@
 from . import ontario
 import os
 import datetime
+import hashlib
 from typing import Dict
 # autopep8 on
 
@@ -26,11 +27,15 @@ class _ImageInfo:
     # The image creation time.
     creation_time: datetime.datetime
 
+    # The SHA-256 hash of the image file's contents.
+    content_hash: str
+
     def __init__(self, id: int, path: str, size: int):
         self.id = id
         self.path = path
         self.size = size
         self.creation_time = datetime.datetime.now()
+        self.content_hash = _hash_file(path)
 
     def delete(self) -> None:
         """
@@ -40,6 +45,18 @@ class _ImageInfo:
         os.remove(self.path)
 
 
+def _hash_file(path: str) -> str:
+    """
+    Returns the SHA-256 hash of a file's contents.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class ImageManager:
     """
     Manages the images on disk.
@@ -108,6 +125,13 @@ class ImageManager:
 
         return self.__extension
 
+    def root(self) -> str:
+        """
+        Returns the root directory for images.
+        """
+
+        return self.__root
+
     def add_image(self, path: str) -> int:
         """
         Adds an image to the image manager.
@@ -127,9 +151,10 @@ class ImageManager:
             raise Exception(f"Source image {path} is empty.")
 
         # Transcode the image from its current format to the desired format.
+        # The source is a temporary upload, so don't keep it decoded.
         context = ontario.ImageContext()
         ontario.ImageBuilder(context).load_from_file(
-            path).save_to_file(image_path).process()
+            path, cache=False).save_to_file(image_path).process()
 
         if not os.path.exists(image_path):
             raise Exception(f"Image {image_path} does not exist.")
@@ -157,6 +182,13 @@ class ImageManager:
 
         return self.__image_map[image_id].path
 
+    def content_hash_for_id(self, image_id: int) -> str:
+        """
+        Returns the hash of the contents of the image with the given ID.
+        """
+
+        return self.__image_map[image_id].content_hash
+
     def clean_up(self) -> None:
         """
         Cleans up the image manager.
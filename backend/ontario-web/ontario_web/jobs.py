@@ -0,0 +1,361 @@
+# GNU AGPL v3 License
+# File-backed queue of pipelines rendered in the background.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .image_manager import ImageManager
+from . import processor
+from . import render_pool
+
+# Job states. Jobs move from queued to running to done or failed.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _write_json(p: str, value: Any) -> None:
+    """
+    Replaces a JSON file at once, so readers never see partial files.
+    """
+
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(p), prefix=".")
+    with os.fdopen(fd, "w") as f:
+        json.dump(value, f)
+    os.replace(temp, p)
+
+
+def _read_json(p: str) -> Any:
+    with open(p, "r") as f:
+        return json.load(f)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _run_job(job_dir: str) -> None:
+    """
+    Renders a job in a worker process, writing progress as it goes.
+    """
+
+    state_path = os.path.join(job_dir, "job.json")
+    job = _read_json(state_path)
+    pipeline = _read_json(os.path.join(job_dir, "pipeline.json"))
+
+    job["status"] = RUNNING
+    job["progress"] = 0.0
+    _write_json(state_path, job)
+
+    # Only write progress once it moved by a percent, or every half second.
+    last = [0.0, time.monotonic()]
+
+    def progress(fraction: float) -> None:
+        now = time.monotonic()
+        if fraction - last[0] < 0.01 and now - last[1] < 0.5:
+            return
+        last[0], last[1] = fraction, now
+        job["progress"] = fraction
+        _write_json(state_path, job)
+
+    data = processor.process(
+        pipeline,
+        render_pool.ImageSnapshot(job["images"]),
+        None,
+        progress=progress,
+        format=job["format"],
+        quality=job["quality"],
+    )
+
+    fd, temp = tempfile.mkstemp(dir=job_dir, prefix=".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp, os.path.join(job_dir, f"result.{job['format']}"))
+
+
+class JobQueue:
+    """
+    Renders pipelines in a bounded pool of worker processes, see
+    render_pool.RenderPool.
+
+    Each job is a directory holding the pipeline, its state and, once it is
+    done, the rendered image. Since the state lives on disk, any process
+    sharing the root can report on any job, and jobs left over by a previous
+    run are picked up again. The process that starts a job claims it with a
+    lock file, so several web workers can share one queue.
+    """
+
+    # The directory the jobs are stored in.
+    __root: str
+
+    # The maximum number of jobs rendered at once by this process.
+    __workers: int
+
+    # The pool rendering the jobs.
+    __pool: render_pool.RenderPool
+
+    # Map between the IDs of the jobs this process runs and their futures.
+    __running: Dict[str, Future]
+
+    # The IDs of the running jobs that were started again in a process of
+    # their own, after a worker crashed.
+    __isolated: Set[str]
+
+    # Whether the queue was shut down, so no more jobs are started.
+    __closed: bool
+
+    # Guards the pool and the running jobs.
+    __lock: threading.Lock
+
+    def __init__(
+        self,
+        root: str,
+        workers: int,
+        max_tasks: int = 0,
+        memory_limit: int = 0,
+        address_limit: int = 0,
+    ):
+        os.makedirs(root, exist_ok=True)
+        self.__root = root
+        self.__workers = workers
+        self.__pool = render_pool.RenderPool(
+            workers, max_tasks, memory_limit, address_limit=address_limit)
+        self.__running = {}
+        self.__isolated = set()
+        self.__closed = False
+        self.__lock = threading.Lock()
+
+    def __path(self, job_id: str, name: str = "") -> str:
+        return os.path.join(self.__root, job_id, name)
+
+    def __valid_id(self, job_id: str) -> bool:
+        try:
+            return uuid.UUID(hex=job_id).hex == job_id
+        except ValueError:
+            return False
+
+    def submit(
+        self,
+        pipeline,
+        images: ImageManager,
+        format: str = "png",
+        quality: Optional[int] = None,
+    ) -> str:
+        """
+        Queues a pipeline to be rendered, returning the ID of the job.
+
+        The images the pipeline uses must exist, or a KeyError is raised, and
+        a RenderTooLarge is raised if it needs too much memory.
+        """
+
+        if isinstance(pipeline, str):
+            pipeline = json.loads(pipeline)
+
+        used = render_pool.snapshot_images(pipeline, images)
+        self.__pool.check_size(pipeline, images)
+
+        job_id = uuid.uuid4().hex
+        job_dir = self.__path(job_id)
+        os.makedirs(job_dir)
+        _write_json(self.__path(job_id, "pipeline.json"), pipeline)
+        _write_json(self.__path(job_id, "job.json"), {
+            "id": job_id,
+            "status": QUEUED,
+            "progress": 0.0,
+            "error": None,
+            "format": format,
+            "quality": quality,
+            "images": used,
+            "created": time.time(),
+            "finished": None,
+        })
+
+        self.dispatch()
+        return job_id
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the ID, status, progress and error of a job, or None if there
+        is no such job.
+        """
+
+        if not self.__valid_id(job_id):
+            return None
+        try:
+            job = _read_json(self.__path(job_id, "job.json"))
+        except FileNotFoundError:
+            return None
+        return {
+            key: job[key] for key in ("id", "status", "progress", "error")
+        }
+
+    def result_path(self, job_id: str) -> Optional[Tuple[str, str]]:
+        """
+        Returns the path and format of a finished job's image, or None if the
+        job is not done.
+        """
+
+        if not self.__valid_id(job_id):
+            return None
+        try:
+            job = _read_json(self.__path(job_id, "job.json"))
+        except FileNotFoundError:
+            return None
+        if job["status"] != DONE:
+            return None
+        return self.__path(job_id, f"result.{job['format']}"), job["format"]
+
+    def __claim(self, job_id: str) -> bool:
+        """
+        Takes the lock file of a job, clearing it first if the process that
+        held it is gone.
+        """
+
+        claim = self.__path(job_id, "claim")
+        for _ in range(2):
+            try:
+                fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(claim, "r") as f:
+                        owner = int(f.read() or 0)
+                except (FileNotFoundError, ValueError):
+                    return False
+                if owner == 0 or _is_alive(owner):
+                    return False
+                try:
+                    os.remove(claim)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(str(os.getpid()))
+            return True
+        return False
+
+    def __queued(self) -> List[str]:
+        """
+        Returns the IDs of the jobs that have not finished, oldest first.
+        """
+
+        jobs = []
+        for job_id in os.listdir(self.__root):
+            try:
+                job = _read_json(self.__path(job_id, "job.json"))
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                continue
+            if job["status"] in (QUEUED, RUNNING):
+                jobs.append((job["created"], job_id))
+        return [job_id for _, job_id in sorted(jobs)]
+
+    def dispatch(self) -> None:
+        """
+        Starts queued jobs while this process has free workers.
+        """
+
+        started = []
+        with self.__lock:
+            if self.__closed:
+                return
+            for job_id in self.__queued():
+                if len(self.__running) >= self.__workers:
+                    break
+                if job_id in self.__running or not self.__claim(job_id):
+                    continue
+
+                future = self.__pool.submit(_run_job, self.__path(job_id))
+                self.__running[job_id] = future
+                started.append((job_id, future))
+
+        # Finished futures run their callbacks right away, so add them once
+        # the lock is released.
+        for job_id, future in started:
+            future.add_done_callback(
+                lambda future, job_id=job_id: self.__finish(job_id, future)
+            )
+
+    def __finish(self, job_id: str, future: Future) -> None:
+        """
+        Records the outcome of a job and starts the next one.
+
+        A crashed worker fails every job in the pool, so those are started
+        again in a process of their own, and only fail if they crash by
+        themselves.
+        """
+
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            with self.__lock:
+                retry = not self.__closed and job_id not in self.__isolated
+                if retry:
+                    self.__isolated.add(job_id)
+                    future = self.__pool.isolate(
+                        _run_job, self.__path(job_id))
+                    self.__running[job_id] = future
+            if retry:
+                future.add_done_callback(
+                    lambda future: self.__finish(job_id, future))
+                return
+            error = render_pool.RenderCrashed(
+                "The render crashed its worker process.")
+
+        state_path = self.__path(job_id, "job.json")
+        job = _read_json(state_path)
+        if error is None:
+            job["status"] = DONE
+            job["progress"] = 1.0
+        else:
+            job["status"] = FAILED
+            job["error"] = str(error) or type(error).__name__
+        job["finished"] = time.time()
+        _write_json(state_path, job)
+
+        with self.__lock:
+            del self.__running[job_id]
+            self.__isolated.discard(job_id)
+            try:
+                os.remove(self.__path(job_id, "claim"))
+            except FileNotFoundError:
+                pass
+
+        self.dispatch()
+
+    def clean_up(self, max_age: float) -> None:
+        """
+        Removes finished jobs older than the given number of seconds.
+        """
+
+        now = time.time()
+        for job_id in os.listdir(self.__root):
+            try:
+                job = _read_json(self.__path(job_id, "job.json"))
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                continue
+            finished = job.get("finished")
+            if finished is not None and now - finished > max_age:
+                shutil.rmtree(self.__path(job_id), ignore_errors=True)
+
+    def shutdown(self) -> None:
+        """
+        Stops the worker processes, waiting for running jobs to finish.
+        """
+
+        with self.__lock:
+            self.__closed = True
+        self.__pool.shutdown()
@@ -1,8 +1,15 @@
 # GNU AGPL v3 License
 # Written by John Nunley
 
+import threading
+import time
+
 from abc import ABC, abstractmethod
-from typing import TypeVar, Generic, Callable, Optional, Any, Union, List, Dict
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import (
+    TypeVar, Generic, Callable, Optional, Any, Union, List, Dict, Set, Tuple
+)
 
 MAX_NODES = 1 << 24
 
@@ -10,11 +17,81 @@ T = TypeVar('T')
 M = TypeVar('M')
 
 
+class TraceSpan:
+    """
+    A record of one node being evaluated.
+    """
+
+    __slots__ = ("template", "id", "wallTime", "cpuTime", "cacheHit")
+
+    # The name of the node's template.
+    template: str
+
+    # The ID number of the node.
+    id: int
+
+    # Wall-clock seconds spent running the node.
+    wallTime: float
+
+    # CPU seconds spent by the thread that ran the node.
+    cpuTime: float
+
+    # Whether the node's cached outputs were reused instead of running it.
+    cacheHit: bool
+
+    def __init__(self, template: str, id: int, wallTime: float,
+                 cpuTime: float, cacheHit: bool):
+        self.template = template
+        self.id = id
+        self.wallTime = wallTime
+        self.cpuTime = cpuTime
+        self.cacheHit = cacheHit
+
+    def __repr__(self):
+        status = "hit" if self.cacheHit else "miss"
+        return (f"TraceSpan({self.template}, {self.id}, "
+                f"{self.wallTime * 1000:.3f}ms, {status})")
+
+
+# A callback that receives a span for every node that is evaluated.
+Tracer = Callable[[TraceSpan], None]
+
+
+class CollectingTracer:
+    """
+    A tracer that keeps every span it receives.
+    """
+
+    # The spans received so far.
+    __spans: List[TraceSpan]
+
+    # Guards the spans, since nodes may run on several threads.
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__spans = []
+        self.__lock = threading.Lock()
+
+    def __call__(self, span: TraceSpan):
+        with self.__lock:
+            self.__spans.append(span)
+
+    def getSpans(self) -> List[TraceSpan]:
+        """
+        Returns the spans received so far.
+        """
+
+        with self.__lock:
+            return list(self.__spans)
+
+
 class _HydrateTarget(ABC):
     """
     A target for hydrating a node.
     """
 
+    __slots__ = ()
+
     @abstractmethod
     def isNoNode(self) -> bool:
         """
@@ -43,16 +120,16 @@ class _HydrateTarget(ABC):
 class _NoNode(_HydrateTarget):
     """
     A stand-in for a node that doesn't exist.
+
+    It holds no state, so every empty link endpoint shares _NO_NODE.
     """
 
-    def __init__(self):
-        pass
+    __slots__ = ()
 
     def isNoNode(self) -> bool:
-        return False
+        return True
 
     def hydrate(self):
-        print("No node to hydrate.")
         pass
 
     def templateName(self) -> str:
@@ -62,11 +139,16 @@ class _NoNode(_HydrateTarget):
         return "NoNode"
 
 
+_NO_NODE = _NoNode()
+
+
 class LinkTemplate(Generic[T, M]):
     """
     A template for creating a link.
     """
 
+    __slots__ = ("__metadata", "__defaultValue", "__name")
+
     # Metadata for the link.
     __metadata: M
 
@@ -108,6 +190,18 @@ class Link(Generic[T, M]):
     A link between two nodes.
     """
 
+    __slots__ = (
+        "__template",
+        "__id",
+        "__from",
+        "__to",
+        "__fromIndex",
+        "__toIndex",
+        "__metadata",
+        "_value",
+        "_dirty",
+    )
+
     # The template for the link.
     __template: LinkTemplate[T, M]
 
@@ -138,8 +232,8 @@ class Link(Generic[T, M]):
     def __init__(self, template: LinkTemplate[T, M], metadata: M, id: int):
         self.__template = template
         self.__id = id
-        self.__from = _NoNode()
-        self.__to = _NoNode()
+        self.__from = _NO_NODE
+        self.__to = _NO_NODE
         self.__fromIndex = -1
         self.__toIndex = -1
         self.__metadata = metadata
@@ -180,12 +274,36 @@ class Link(Generic[T, M]):
         self.__to = node
         self.__toIndex = index
 
+    def getFrom(self) -> _HydrateTarget:
+        return self.__from
+
+    def getTo(self) -> _HydrateTarget:
+        return self.__to
+
+    def getFromId(self) -> Optional[int]:
+        """
+        Returns the ID of the node this link comes from, if any.
+        """
+
+        if self.__from.isNoNode():
+            return None
+        return self.__from.getId()
+
+    def getToId(self) -> Optional[int]:
+        """
+        Returns the ID of the node this link goes to, if any.
+        """
+
+        if self.__to.isNoNode():
+            return None
+        return self.__to.getId()
+
     def clearFrom(self):
-        self.__from = _NoNode()
+        self.__from = _NO_NODE
         self.__fromIndex = -1
 
     def clearTo(self):
-        self.__to = _NoNode()
+        self.__to = _NO_NODE
         self.__toIndex = -1
 
     def isDirty(self):
@@ -198,11 +316,16 @@ class Link(Generic[T, M]):
     def hydrate(self):
         """
         Hydrates the link.
+
+        If the link is clean, the cached value is reused and the node it
+        comes from is not run again.
         """
 
-        print(f"Hydrating link, {self.__from} -> {self.__to}")
+        if not self._dirty:
+            return
+
         self.__from.hydrate()
-        print(f"Finished hydrating link, {self.__from} -> {self.__to}")
+        self._dirty = False
 
     def getValue(self) -> T:
         """
@@ -330,16 +453,37 @@ class TemplateTable(Generic[T, M]):
     # The table of node templates.
     __nodeTemplates: Dict[str, NodeTemplate[T, M]]
 
+    # Whether the table can no longer be changed.
+    __frozen: bool
+
     def __init__(self):
         self.__nodeTemplates = {}
+        self.__frozen = False
 
     def addTemplate(self, name: str, template: NodeTemplate[T, M]):
         """
         Adds a template to the table.
         """
 
+        if self.__frozen:
+            raise RuntimeError("Cannot add templates to a frozen table")
+
         self.__nodeTemplates[name] = template
 
+    def freeze(self):
+        """
+        Makes the table immutable, so it can be shared between pipelines.
+        """
+
+        self.__frozen = True
+
+    def isFrozen(self) -> bool:
+        """
+        Returns whether the table is immutable.
+        """
+
+        return self.__frozen
+
     def getTemplate(self, name: str) -> Optional[NodeTemplate[T, M]]:
         """
         Returns a template from the table.
@@ -360,12 +504,28 @@ class Node(Generic[T, M], _HydrateTarget):
     A node in the graph.
     """
 
+    __slots__ = (
+        "__templateTable",
+        "__template",
+        "__nodeTemplate",
+        "__id",
+        "__metadata",
+        "__inputs",
+        "__outputs",
+        "__consumers",
+        "__values",
+        "_tracer",
+    )
+
     # The template table that we're using.
     __templateTable: TemplateTable[T, M]
 
     # The template for the node.
     __template: str
 
+    # The resolved template for the node.
+    __nodeTemplate: NodeTemplate[T, M]
+
     # The ID number of the node.
     __id: int
 
@@ -378,9 +538,15 @@ class Node(Generic[T, M], _HydrateTarget):
     # The output links.
     __outputs: List[Link[T, M]]
 
+    # Every link connected to each output, for outputs that fan out.
+    __consumers: List[List[Link[T, M]]]
+
     # Custom output values.
     __values: Dict[str, T]
 
+    # The tracer that receives a span for each run, or None.
+    _tracer: Optional[Tracer]
+
     def __init__(
         self,
         templateTable: TemplateTable[T, M],
@@ -393,13 +559,16 @@ class Node(Generic[T, M], _HydrateTarget):
         self.__template = template
         self.__id = id
         self.__metadata = metadata
-        self.__values = values
-        if self.__values is None:
+        if values is None:
             raise ValueError("Values cannot be None")
+        # Keep our own copy, so setValue doesn't change the caller's dict.
+        self.__values = dict(values)
+        self._tracer = None
 
-        template = templateTable.getTemplate(template)
+        template = templateTable.getTemplate(self.__template)
         if template is None:
-            raise ValueError(f"Unknown template {template}")
+            raise ValueError(f"Unknown template {self.__template}")
+        self.__nodeTemplate = template
         lastLinkId = id + MAX_NODES
 
         self.__inputs = []
@@ -428,6 +597,8 @@ class Node(Generic[T, M], _HydrateTarget):
             )
             lastLinkId += MAX_NODES
 
+        self.__consumers = [[] for _ in self.__outputs]
+
     def getTemplateTable(self) -> TemplateTable[T, M]:
         """
         Returns the template table.
@@ -442,6 +613,13 @@ class Node(Generic[T, M], _HydrateTarget):
 
         return self.__template
 
+    def getNodeTemplate(self) -> NodeTemplate[T, M]:
+        """
+        Returns the resolved template.
+        """
+
+        return self.__nodeTemplate
+
     def getId(self) -> int:
         """
         Returns the ID number of the node.
@@ -484,37 +662,130 @@ class Node(Generic[T, M], _HydrateTarget):
 
         self.__metadata = metadata
 
+    def getValues(self) -> Dict[str, T]:
+        """
+        Returns the custom values of the node.
+        """
+
+        return self.__values
+
+    def setValues(self, values: Dict[str, T]):
+        """
+        Replaces the custom values of the node.
+
+        This node and every node downstream of it are marked dirty, so the
+        next evaluation recomputes them and reuses everything else.
+        """
+
+        if values is None:
+            raise ValueError("Values cannot be None")
+
+        self.__values = dict(values)
+        self._invalidateDownstream()
+
+    def setValue(self, name: str, value: T):
+        """
+        Sets one custom value of the node, marking it dirty like setValues.
+        """
+
+        self.__values[name] = value
+        self._invalidateDownstream()
+
     def isNoNode(self) -> bool:
         return False
 
     def hydrate(self):
-        print("Hydrating node", self.__id)
+        tracer = self._tracer
+        if tracer is not None:
+            start = time.perf_counter()
+            startCpu = time.thread_time()
 
         # Process the node.
-        print(f"Links are {self.__inputs}")
+        template = self.__nodeTemplate
         for i, link in enumerate(self.__inputs):
-            name = self.__templateTable.getTemplate(
-                self.__template).getNamedInput(i)
+            name = template.getNamedInput(i)
             if name is not None and name in self.__values:
                 link.setValue(self.__values[name])
             else:
                 link.getValue()
-        template = self.__templateTable.getTemplate(self.__template)
         outputs = template.process(self.__inputs, self.__metadata)
-        # print(f"Called hydrate, got {outputs}")
 
         # Set the outputs.
         for i in range(len(outputs)):
-            name = self.__templateTable.getTemplate(
-                self.__template).getNamedOutput(i)
-            print(f"- {name}")
+            name = template.getNamedOutput(i)
             if name is not None and name in self.__values:
-                self.__outputs[i]._value = self.__values[name]
+                value = self.__values[name]
             else:
-                self.__outputs[i]._value = outputs[i]
-            self.__outputs[i]._dirty = False
+                value = outputs[i]
+            self.__setOutput(i, value)
+
+        if tracer is not None:
+            tracer(TraceSpan(
+                self.__template,
+                self.__id,
+                time.perf_counter() - start,
+                time.thread_time() - startCpu,
+                False,
+            ))
+
+    def presetOutputs(self, values: List[T]):
+        """
+        Sets the output values directly and marks them clean.
+
+        This lets a caller seed a node from a cache; evaluation then reuses
+        the values and skips everything upstream of the node.
+        """
+
+        for i, value in enumerate(values):
+            self.__setOutput(i, value)
+
+    def __setOutput(self, index: int, value: T):
+        """
+        Writes a value to every link connected to an output.
+        """
+
+        self.__outputs[index]._value = value
+        self.__outputs[index]._dirty = False
+        for link in self.__consumers[index]:
+            link._value = value
+            link._dirty = False
+
+    def _isDirty(self) -> bool:
+        """
+        (PRIVATE) Returns whether the node needs to be run again.
+        """
+
+        return any(link._dirty for link in self.__outputs)
+
+    def _invalidateDownstream(self):
+        """
+        (PRIVATE) Marks this node and every node that depends on it as dirty.
+        """
+
+        stack = [self]
+        visited = set()
+        while stack:
+            node = stack.pop()
+            if node.__id in visited:
+                continue
+            visited.add(node.__id)
 
-        print("Done hydrating node", self.__id)
+            for i, output in enumerate(node.__outputs):
+                output._dirty = True
+                for link in node.__consumers[i]:
+                    link._dirty = True
+                    if link.isToOccupied():
+                        stack.append(link.getTo())
+
+    def _invalidate(self):
+        """
+        (PRIVATE) Marks every link around this node as dirty.
+        """
+
+        for link in self.__inputs:
+            link._dirty = True
+        for link in self.__outputs:
+            link._dirty = True
 
     def _setOutputLink(self, link: Link[T, M], index: int):
         """
@@ -531,7 +802,7 @@ class Node(Generic[T, M], _HydrateTarget):
         if index < 0:
             return
 
-        template = self.__templateTable.getTemplate(self.__template)
+        template = self.__nodeTemplate
 
         if input:
             input_template = template.getInputs().get(index)
@@ -569,6 +840,7 @@ class Node(Generic[T, M], _HydrateTarget):
 
         link = self.__inputs[to_index]
         from_node.__outputs[from_index] = link
+        from_node.__consumers[from_index].append(link)
         link.setFrom(from_node, from_index)
         link.setTo(self, to_index)
         link.setMetadata(meta)
@@ -645,19 +917,26 @@ class Pipeline(Generic[T, M]):
     # The ID number of the output node, or None if there is no output node.
     __outputId: Optional[int]
 
+    # The tracer given to every node, or None.
+    __tracer: Optional[Tracer]
+
     def __init__(self, templateTable: TemplateTable[T, M]):
         self.__nodes = {}
         self.__links = {}
         self.__templateTable = templateTable
         self.__nextId = 0
         self.__outputId = None
+        self.__tracer = None
 
     def createNode(self, template: str, metadata: M,
-                   values={}, id=None) -> Node[T, M]:
+                   values=None, id=None) -> Node[T, M]:
         """
         Creates a node.
         """
 
+        if values is None:
+            values = {}
+
         if not id:
             id = self.__nextId
             self.__nextId += 1
@@ -669,6 +948,7 @@ class Pipeline(Generic[T, M]):
             values,
             metadata,
             id)
+        node._tracer = self.__tracer
         self.__nodes[id] = node
         return node
 
@@ -727,6 +1007,20 @@ class Pipeline(Generic[T, M]):
 
         return list(self.__nodes.values())
 
+    def setValues(self, id: int, values: Dict[str, T]) -> None:
+        """
+        Replaces the values of a node and invalidates its downstream cone.
+        """
+
+        self.__nodes[id].setValues(values)
+
+    def getLinks(self) -> List[Link[T, M]]:
+        """
+        Returns all links.
+        """
+
+        return list(self.__links.values())
+
     def getOutputNode(self) -> Optional[Node[T, M]]:
         """
         Returns the output node.
@@ -744,6 +1038,259 @@ class Pipeline(Generic[T, M]):
 
         self.__outputId = id
 
+    def setTracer(self, tracer: Optional[Tracer]) -> None:
+        """
+        Sets the tracer that receives a span for every node evaluation.
+
+        Tracing is disabled with None, which is the default.
+        """
+
+        self.__tracer = tracer
+        for node in self.__nodes.values():
+            node._tracer = tracer
+
+    def evaluate(self) -> T:
+        """
+        Evaluates the pipeline and returns the value of the output node.
+
+        Each node runs at most once per evaluation; a node whose output
+        fans out to several consumers shares its cached value between them.
+        """
+
+        return self.compile().evaluate(self)
+
+    def invalidate(self) -> None:
+        """
+        Marks every node as dirty, so the next evaluation runs all of them.
+        """
+
+        for node in self.__nodes.values():
+            node._invalidate()
+
+    def shape(self) -> "PipelineShape":
+        """
+        Returns a hashable description of the graph, ignoring node values.
+        """
+
+        nodes = tuple(sorted(
+            (id, node.getTemplate()) for id, node in self.__nodes.items()
+        ))
+        links = tuple(sorted(
+            (
+                link.getFromId(),
+                link.getFromIndex(),
+                link.getToId(),
+                link.getToIndex(),
+            )
+            for link in self.__links.values()
+            if link.isFromOccupied() and link.isToOccupied()
+        ))
+        return (nodes, links, self.__outputId)
+
+    def compile(self) -> "CompiledPipeline[T, M]":
+        """
+        Sorts the nodes topologically and returns a reusable plan.
+
+        Raises a ValueError if the graph contains a cycle or has no output.
+        """
+
+        if self.__outputId is None:
+            raise ValueError("No output node.")
+
+        # Build the adjacency lists from the link table.
+        upstream: Dict[int, List[int]] = {id: [] for id in self.__nodes}
+        downstream: Dict[int, List[int]] = {id: [] for id in self.__nodes}
+        for link in self.__links.values():
+            fromId = link.getFromId()
+            toId = link.getToId()
+            if fromId is None or toId is None:
+                continue
+            upstream[toId].append(fromId)
+            downstream[fromId].append(toId)
+
+        # Kahn's algorithm, visiting ready nodes in ID order.
+        indegree = {id: len(ids) for id, ids in upstream.items()}
+        ready = deque(sorted(id for id, n in indegree.items() if n == 0))
+        order = []
+        while ready:
+            id = ready.popleft()
+            order.append(id)
+            for nextId in downstream[id]:
+                indegree[nextId] -= 1
+                if indegree[nextId] == 0:
+                    ready.append(nextId)
+
+        if len(order) != len(self.__nodes):
+            raise ValueError("Pipeline contains a cycle.")
+
+        # Only the nodes that the output depends on need to run.
+        needed = {self.__outputId}
+        stack = [self.__outputId]
+        while stack:
+            for fromId in upstream[stack.pop()]:
+                if fromId not in needed:
+                    needed.add(fromId)
+                    stack.append(fromId)
+
+        return CompiledPipeline(
+            self.shape(),
+            [id for id in order if id in needed],
+            {id: upstream[id] for id in needed},
+        )
+
+
+# Nodes as (id, template), links as (from, fromIndex, to, toIndex), output ID.
+PipelineShape = Tuple[
+    Tuple[Tuple[int, str], ...],
+    Tuple[Tuple[int, int, int, int], ...],
+    Optional[int],
+]
+
+
+class CompiledPipeline(Generic[T, M]):
+    """
+    A topologically sorted evaluation plan for pipelines of one shape.
+
+    The plan only depends on the graph, so it can be reused for any pipeline
+    with the same nodes and links, whatever their values are.
+    """
+
+    # The shape of the pipelines this plan can evaluate.
+    __shape: PipelineShape
+
+    # Node IDs in evaluation order, ending with the output node.
+    __order: List[int]
+
+    # The IDs of the nodes that each node takes its inputs from.
+    __upstream: Dict[int, List[int]]
+
+    def __init__(
+        self,
+        shape: PipelineShape,
+        order: List[int],
+        upstream: Dict[int, List[int]],
+    ):
+        self.__shape = shape
+        self.__order = order
+        self.__upstream = upstream
+
+    def getShape(self) -> PipelineShape:
+        """
+        Returns the shape of the pipelines this plan can evaluate.
+        """
+
+        return self.__shape
+
+    def getOrder(self) -> List[int]:
+        """
+        Returns the node IDs in evaluation order.
+        """
+
+        return self.__order
+
+    def evaluate(self, pipeline: Pipeline[T, M], workers: int = 1) -> T:
+        """
+        Evaluates a pipeline with this plan and returns the output value.
+
+        Nodes run in topological order, so every input is already hydrated
+        by the time a node runs and evaluation never recurses. With more
+        than one worker, nodes whose inputs are ready run concurrently on a
+        thread pool, and a node with several inputs waits for all of them.
+        """
+
+        if pipeline.shape() != self.__shape:
+            raise ValueError("Pipeline does not match the compiled shape.")
+
+        stale = self.__staleNodes(pipeline)
+        if workers > 1:
+            self.__evaluateParallel(pipeline, stale, workers)
+        else:
+            for id in self.__order:
+                node = pipeline.getNode(id)
+                if id in stale:
+                    node.hydrate()
+                else:
+                    _traceHit(node)
+
+        return pipeline.getOutputNode().getOutputs()[0].getValue()
+
+    def __staleNodes(self, pipeline: Pipeline[T, M]) -> Set[int]:
+        """
+        Returns the dirty nodes that the output still needs.
+
+        Walking back from the output over dirty links only, a node with
+        clean outputs (cached, or preset with presetOutputs) stops the walk,
+        so nothing upstream of it runs.
+        """
+
+        stale = set()
+        outputId = self.__order[-1]
+        if pipeline.getNode(outputId)._isDirty():
+            stale.add(outputId)
+
+        for id in reversed(self.__order):
+            if id not in stale:
+                continue
+            for link in pipeline.getNode(id).getInputs():
+                fromId = link.getFromId()
+                if fromId is not None and link.isDirty():
+                    stale.add(fromId)
+
+        return stale
+
+    def __evaluateParallel(
+        self,
+        pipeline: Pipeline[T, M],
+        stale: Set[int],
+        workers: int,
+    ):
+        """
+        Runs the stale nodes of the plan on a pool of worker threads.
+        """
+
+        for id in self.__order:
+            if id not in stale:
+                _traceHit(pipeline.getNode(id))
+
+        # Count the inputs each node still waits on.
+        remaining = {id: 0 for id in stale}
+        dependents: Dict[int, List[int]] = {id: [] for id in stale}
+        for id in stale:
+            for fromId in self.__upstream[id]:
+                if fromId in stale:
+                    remaining[id] += 1
+                    dependents[fromId].append(id)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def submit(id):
+                future = executor.submit(pipeline.getNode(id).hydrate)
+                running[future] = id
+
+            running = {}
+            for id in self.__order:
+                if id in stale and remaining[id] == 0:
+                    submit(id)
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    id = running.pop(future)
+                    future.result()
+                    for nextId in dependents[id]:
+                        remaining[nextId] -= 1
+                        if remaining[nextId] == 0:
+                            submit(nextId)
+
+
+def _traceHit(node: Node[T, M]):
+    """
+    Reports a node whose cached outputs are reused to its tracer.
+    """
+
+    if node._tracer is not None and not node._isDirty():
+        node._tracer(TraceSpan(
+            node.getTemplate(), node.getId(), 0.0, 0.0, True))
+
 
 SerializedLink = Dict[str, Any]
 SerializedNode = Dict[str, Any]
@@ -795,7 +1342,6 @@ def deserializePipeline(
     pipeline = Pipeline(templateTable)
 
     for serializedNode in serialized["nodes"]:
-        print(serializedNode)
         node = pipeline.createNode(
             serializedNode["template"],
             serializedNode.get("metadata", None),
@@ -2,50 +2,894 @@
 # Written by John Nunley
 # libnodepy-based pipeline processor, using ontario as a backend.
 
+import hashlib
+import io
 import json
+import threading
+import time
+import zipfile
+
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import path
 
 from .image_manager import ImageManager
+from .render_cache import RenderCache
 from . import nodes
 
-from .ontario import ImageContext, ImageBuilder
+from .ontario import (
+    CancellationToken,
+    ImageBuilder,
+    ImageContext,
+    ProgressCallback,
+    Rect,
+    image_size,
+)
 
-from typing import Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 PipelineUnit = Union[ImageBuilder, int]
 
+# The maximum number of compiled plans to keep around.
+MAX_COMPILED_PLANS = 256
+
+# Compiled plans, keyed by pipeline shape, in least recently used order.
+_compiled_plans: OrderedDict = OrderedDict()
+_compiled_plans_lock = threading.Lock()
+
+
+def compile_pipeline(pipeline: nodes.Pipeline) -> nodes.CompiledPipeline:
+    """
+    Returns the compiled plan for a pipeline, reusing one for the same shape.
+    """
+
+    shape = pipeline.shape()
+    with _compiled_plans_lock:
+        plan = _compiled_plans.get(shape)
+        if plan is not None:
+            _compiled_plans.move_to_end(shape)
+            return plan
+
+    plan = pipeline.compile()
+    with _compiled_plans_lock:
+        _compiled_plans[shape] = plan
+        while len(_compiled_plans) > MAX_COMPILED_PLANS:
+            _compiled_plans.popitem(last=False)
+
+    return plan
+
+
+# The maximum number of pipeline shapes to keep GEGL graphs for, and the
+# number of graphs kept per shape for concurrent requests.
+MAX_POOLED_SHAPES = 64
+MAX_GRAPHS_PER_SHAPE = 4
+
+# Idle image contexts, keyed by pipeline shape, preview scale and the IDs of
+# the nodes seeded from intermediates, in least recently used order.
+_graph_pool: OrderedDict = OrderedDict()
+_graph_pool_lock = threading.Lock()
+
+
+def acquire_graph(
+    shape: nodes.PipelineShape,
+    preview_scale: float = 1.0,
+    seeded: FrozenSet[int] = frozenset(),
+) -> ImageContext:
+    """
+    Returns an image context for building a pipeline of the given shape.
+
+    If an earlier pipeline of that shape released its context, the context
+    is rewound, so building the pipeline again reuses its GEGL nodes and
+    only updates what changed. Otherwise a new context is created.
+
+    Seeded nodes are built as buffer sources and skip the nodes upstream of
+    them, so graphs are only shared by pipelines seeded at the same nodes.
+    """
+
+    key = (shape, preview_scale, seeded)
+    with _graph_pool_lock:
+        contexts = _graph_pool.get(key)
+        if contexts:
+            context = contexts.pop()
+            if not contexts:
+                del _graph_pool[key]
+            context.rewind()
+            return context
+
+    return ImageContext(preview_scale=preview_scale)
+
+
+def release_graph(
+    shape: nodes.PipelineShape,
+    context: ImageContext,
+    preview_scale: float = 1.0,
+    seeded: FrozenSet[int] = frozenset(),
+) -> None:
+    """
+    Returns a context to the pool once its render has finished.
+    """
+
+    context.trim()
+    key = (shape, preview_scale, seeded)
+    evicted = []
+    with _graph_pool_lock:
+        contexts = _graph_pool.setdefault(key, [])
+        if len(contexts) < MAX_GRAPHS_PER_SHAPE:
+            contexts.append(context)
+        else:
+            evicted.append(context)
+        _graph_pool.move_to_end(key)
+        while len(_graph_pool) > MAX_POOLED_SHAPES:
+            evicted.extend(_graph_pool.popitem(last=False)[1])
+
+    # Free the GEGL nodes and their caches now, not whenever they are
+    # collected.
+    for context in evicted:
+        context.close()
+
+
+class NodeTiming:
+    """
+    Time spent on one node of a profiled pipeline.
+    """
+
+    # The name of the node's template.
+    template: str
+
+    # The ID number of the node.
+    id: int
+
+    # Wall-clock and CPU seconds spent building the node's GEGL operations.
+    build_wall: float
+    build_cpu: float
+
+    # Wall-clock and CPU seconds GEGL spent computing the node's output.
+    gegl_wall: float
+    gegl_cpu: float
+
+    def __init__(self, template: str, id: int):
+        self.template = template
+        self.id = id
+        self.build_wall = 0.0
+        self.build_cpu = 0.0
+        self.gegl_wall = 0.0
+        self.gegl_cpu = 0.0
+
+
+class ProfileReport:
+    """
+    Per-node timings collected while processing a pipeline.
+
+    The report is also a tracer, so it can be given to a pipeline directly.
+    """
+
+    # Timings for each node, in the order they were first seen.
+    __nodes: Dict[int, NodeTiming]
+
+    # Wall-clock and CPU seconds spent saving the output image.
+    __save_wall: float
+    __save_cpu: float
+
+    def __init__(self):
+        self.__nodes = {}
+        self.__save_wall = 0.0
+        self.__save_cpu = 0.0
+
+    def __call__(self, span: nodes.TraceSpan):
+        timing = self.__timing(span.template, span.id)
+        timing.build_wall += span.wallTime
+        timing.build_cpu += span.cpuTime
+
+    def __timing(self, template: str, id: int) -> NodeTiming:
+        if id not in self.__nodes:
+            self.__nodes[id] = NodeTiming(template, id)
+        return self.__nodes[id]
+
+    def add_gegl_time(self, template: str, id: int, wall: float, cpu: float):
+        """
+        Attributes GEGL computation time to a node.
+        """
+
+        timing = self.__timing(template, id)
+        timing.gegl_wall += wall
+        timing.gegl_cpu += cpu
+
+    def set_save_time(self, wall: float, cpu: float):
+        """
+        Records the time spent saving the output image.
+        """
+
+        self.__save_wall = wall
+        self.__save_cpu = cpu
+
+    def nodes(self) -> List[NodeTiming]:
+        """
+        Returns the timings for every node.
+        """
+
+        return list(self.__nodes.values())
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Converts the report to a JSON-equivalent dict.
+
+        Node timings are also summed per template, to show which templates
+        dominate the render time.
+        """
+
+        templates = {}
+        for timing in self.__nodes.values():
+            total = templates.setdefault(timing.template, {
+                "count": 0,
+                "wall": 0.0,
+                "cpu": 0.0,
+            })
+            total["count"] += 1
+            total["wall"] += timing.build_wall + timing.gegl_wall
+            total["cpu"] += timing.build_cpu + timing.gegl_cpu
+
+        return {
+            "nodes": [
+                {
+                    "id": timing.id,
+                    "template": timing.template,
+                    "build_wall": timing.build_wall,
+                    "build_cpu": timing.build_cpu,
+                    "gegl_wall": timing.gegl_wall,
+                    "gegl_cpu": timing.gegl_cpu,
+                }
+                for timing in self.__nodes.values()
+            ],
+            "templates": templates,
+            "save": {
+                "wall": self.__save_wall,
+                "cpu": self.__save_cpu,
+            },
+        }
+
+
+def _profile_gegl(pipeline: nodes.Pipeline, plan: nodes.CompiledPipeline,
+                  profile: ProfileReport) -> None:
+    """
+    Computes each node's image in evaluation order and times it.
+
+    GEGL caches the results of expensive operations, so the time measured
+    for a node is mostly spent in its own operations rather than upstream.
+    CPU time covers the whole process, including GEGL's worker threads.
+    """
+
+    for id in plan.getOrder():
+        node = pipeline.getNode(id)
+        img = node.getOutputs()[0].getValue()
+        if not isinstance(img, ImageBuilder):
+            continue
+
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        img.prerender()
+        profile.add_gegl_time(
+            node.getTemplate(),
+            id,
+            time.perf_counter() - start,
+            time.process_time() - start_cpu,
+        )
+
+
+def subgraph_hashes(
+    pipeline: nodes.Pipeline,
+    plan: nodes.CompiledPipeline,
+    images: ImageManager,
+    preview_scale: float = 1.0,
+) -> Dict[int, str]:
+    """
+    Hashes every node of a plan together with everything upstream of it.
+
+    A node's hash covers its template, its values and the hashes of the
+    nodes feeding its inputs, with image IDs replaced by the hash of the
+    image contents. Nodes with equal hashes produce the same image, no
+    matter what their IDs are or which pipeline they belong to. Previews
+    are hashed apart from full resolution renders.
+    """
+
+    hashes = {}
+    for id in plan.getOrder():
+        node = pipeline.getNode(id)
+        values = dict(node.getValues())
+        if node.getTemplate() == "ImgSrc" and "image" in values:
+            values["image"] = images.content_hash_for_id(values["image"])
+
+        inputs = []
+        for link in node.getInputs():
+            from_id = link.getFromId()
+            if from_id is None:
+                inputs.append(None)
+            else:
+                inputs.append([hashes[from_id], link.getFromIndex()])
+
+        description = [node.getTemplate(), values, inputs]
+        if preview_scale != 1.0:
+            description.append(preview_scale)
+        description = json.dumps(
+            description,
+            sort_keys=True,
+            default=repr,
+        )
+        hashes[id] = hashlib.sha256(description.encode()).hexdigest()
+
+    return hashes
+
+
+def render_key(
+    output_hash: str,
+    target: str,
+    viewport: Optional[Rect] = None,
+    quality: Optional[int] = None,
+) -> str:
+    """
+    Returns the render cache key for saving an output node to a file.
+    """
+
+    extension = path.splitext(target)[1].lower()
+    key = f"{output_hash}{extension}"
+    if viewport is not None:
+        key += ":" + ",".join(str(v) for v in viewport)
+    if quality is not None:
+        key += f"@{quality}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# Bytes per pixel of the "RGBA float" buffers intermediates are kept in.
+INTERMEDIATE_PIXEL_SIZE = 16
+
+# The number of subgraph hashes remembered to tell which ones recur.
+MAX_SEEN_HASHES = 4096
+
+# Templates whose outputs are never kept as intermediates: sources output
+# image IDs and outputs repeat their input.
+_UNCACHED_TEMPLATES = {"ImgSrc", "ImgOut"}
+
+
+class IntermediateCache:
+    """
+    Keeps rendered intermediate images in memory, keyed by subgraph hash.
+
+    The least recently used images are dropped to stay under a byte budget.
+    Storing an image costs a render of its own, so it also remembers which
+    subgraphs it has been offered, and only images that come up again are
+    worth storing.
+    """
+
+    # The maximum total size of the cached buffers, in bytes.
+    __max_size: int
+
+    # The current total size of the cached buffers, in bytes.
+    __current_size: int
+
+    # Map between subgraph hashes and (buffer, size), least recent first.
+    __entries: "OrderedDict[str, Tuple[Any, int]]"
+
+    # Subgraph hashes offered before, least recent first.
+    __seen: "OrderedDict[str, None]"
+
+    # Guards the entries, since requests are handled on several threads.
+    __lock: threading.Lock
+
+    def __init__(self, max_size: int):
+        self.__max_size = max_size
+        self.__current_size = 0
+        self.__entries = OrderedDict()
+        self.__seen = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def seen(self, key: str) -> bool:
+        """
+        Records that the image for a key was rendered, returning whether it
+        had been rendered before.
+        """
+
+        with self.__lock:
+            if key in self.__seen:
+                self.__seen.move_to_end(key)
+                return True
+            self.__seen[key] = None
+            if len(self.__seen) > MAX_SEEN_HASHES:
+                self.__seen.popitem(last=False)
+            return False
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the Gegl.Buffer cached under a key, if there is one.
+        """
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def fits(self, size: int) -> bool:
+        """
+        Returns whether a buffer of the given size can be cached at all.
+        """
+
+        return size <= self.__max_size
+
+    def put(self, key: str, buffer: Any, size: int) -> None:
+        """
+        Caches a Gegl.Buffer of the given size in bytes under a key.
+        """
 
-def process(pipeline, images: ImageManager, target: str) -> None:
+        if not self.fits(size):
+            return
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__current_size -= self.__entries.pop(key)[1]
+            self.__entries[key] = (buffer, size)
+            self.__current_size += size
+
+            while self.__current_size > self.__max_size:
+                _, (_, evicted) = self.__entries.popitem(last=False)
+                self.__current_size -= evicted
+
+    def size(self) -> int:
+        """
+        Returns the current total size of the cached buffers, in bytes.
+        """
+
+        with self.__lock:
+            return self.__current_size
+
+    def __contains__(self, key: str) -> bool:
+        with self.__lock:
+            return key in self.__entries
+
+
+def _find_intermediates(
+    pipeline: nodes.Pipeline,
+    plan: nodes.CompiledPipeline,
+    hashes: Dict[int, str],
+    intermediates: IntermediateCache,
+) -> Dict[int, Any]:
+    """
+    Looks up the deepest cached node on every path into the output.
+
+    Returns the cached buffers by node ID. Presetting those nodes makes
+    evaluation skip everything upstream of them.
+    """
+
+    found = {}
+    visited = set()
+    stack = [plan.getOrder()[-1]]
+    while stack:
+        id = stack.pop()
+        if id in visited:
+            continue
+        visited.add(id)
+
+        node = pipeline.getNode(id)
+        if node.getTemplate() not in _UNCACHED_TEMPLATES:
+            buffer = intermediates.get(hashes[id])
+            if buffer is not None:
+                found[id] = buffer
+                continue
+
+        for link in node.getInputs():
+            if link.getFromId() is not None:
+                stack.append(link.getFromId())
+
+    return found
+
+
+def _store_intermediates(
+    pipeline: nodes.Pipeline,
+    plan: nodes.CompiledPipeline,
+    hashes: Dict[int, str],
+    intermediates: IntermediateCache,
+    seeded: FrozenSet[int],
+) -> None:
+    """
+    Renders the images that are worth reusing into the intermediate cache.
+
+    Every node evaluated here is recorded as seen. On each path into the
+    output, only the deepest node that was also rendered by an earlier
+    request is stored, since seeding starts from the deepest cached node
+    and skips everything upstream of it.
+    """
+
+    stored = []
+    visited = set()
+    stack = [plan.getOrder()[-1]]
+    while stack:
+        id = stack.pop()
+        if id in visited or id in seeded:
+            continue
+        visited.add(id)
+
+        node = pipeline.getNode(id)
+        output = node.getOutputs()[0]
+        if (node.getTemplate() not in _UNCACHED_TEMPLATES
+                and not output.isDirty()
+                and isinstance(output.getValue(), ImageBuilder)):
+            if hashes[id] in intermediates:
+                continue
+            if intermediates.seen(hashes[id]):
+                stored.append(id)
+                continue
+
+        for link in node.getInputs():
+            if link.getFromId() is not None:
+                stack.append(link.getFromId())
+
+    for id in stored:
+        img = pipeline.getNode(id).getOutputs()[0].getValue()
+        _, _, width, height = img.extent()
+        size = width * height * INTERMEDIATE_PIXEL_SIZE
+        if intermediates.fits(size):
+            intermediates.put(hashes[id], img.to_buffer(), size)
+
+
+def process(
+    pipeline,
+    images: ImageManager,
+    target: Optional[str],
+    tracer: Optional[nodes.Tracer] = None,
+    profile: Optional[ProfileReport] = None,
+    cache: Optional[RenderCache] = None,
+    intermediates: Optional[IntermediateCache] = None,
+    viewport: Optional[Rect] = None,
+    preview_scale: float = 1.0,
+    progress: Optional[ProgressCallback] = None,
+    cancel: Optional[CancellationToken] = None,
+    format: str = "png",
+    quality: Optional[int] = None,
+) -> Optional[bytes]:
     """
     Processes a pipeline.
+
+    The output is saved to the target path. If the target is None, it is
+    encoded in memory in the given format and quality instead, and the
+    encoded bytes are returned.
+
+    If a viewport of (x, y, width, height) is given, only that region of the
+    output is computed and saved. If a preview scale below 1 is given, the
+    sources are downscaled by it and sizes in the pipeline are scaled to
+    match. Viewports are in full resolution pixels either way.
+
+    If a progress callback or cancellation token is given, the output is
+    rendered stepwise as it is saved, reporting the fraction done and
+    raising RenderCancelled once the token is cancelled.
+
+    If a tracer is given, it receives a span for every node evaluation.
+    If a profile report is given, it is filled with per-node timings.
+    If a render cache is given, identical pipelines are only rendered once.
+    If an intermediate cache is given, evaluation starts from the deepest
+    node whose subgraph was already rendered, and nodes rendered here that
+    earlier requests rendered too are added to it, unless a viewport is
+    given. Profiled renders bypass both caches.
+
+    The GEGL graph is taken from a pool keyed by the pipeline's shape and
+    the nodes seeded from intermediates, so repeated pipelines only update
+    the sources and properties that changed.
     """
 
     if isinstance(pipeline, str):
         pipeline = json.loads(pipeline)
 
     # Deserialize from JSON
-    pipeline = nodes.deserializePipeline(pipeline, make_template_table())
+    pipeline = nodes.deserializePipeline(pipeline, get_template_table())
+    if profile is not None and tracer is not None:
+        def trace_both(span):
+            tracer(span)
+            profile(span)
+        pipeline.setTracer(trace_both)
+    elif profile is not None:
+        pipeline.setTracer(profile)
+    else:
+        pipeline.setTracer(tracer)
+
+    if pipeline.getOutputNode() is None:
+        raise Exception("No output node.")
+    plan = compile_pipeline(pipeline)
+
+    if profile is not None:
+        cache = None
+        intermediates = None
+    hashes = None
+    if cache is not None or intermediates is not None:
+        hashes = subgraph_hashes(pipeline, plan, images, preview_scale)
+
+    # Reuse an earlier render of the same pipeline and images
+    key = None
+    if cache is not None:
+        key = render_key(
+            hashes[plan.getOrder()[-1]],
+            target if target is not None else f"out.{format}",
+            viewport,
+            quality,
+        )
+        if target is None:
+            data = cache.read(key)
+            if data is not None:
+                return data
+        elif cache.get(key, target):
+            return None
+
+    # Start from intermediates rendered by earlier requests
+    found = {}
+    if intermediates is not None:
+        found = _find_intermediates(pipeline, plan, hashes, intermediates)
+    seeded = frozenset(found)
 
     # set metadata for all nodes
-    context = ImageContext()
-    for node in pipeline.getNodes():
-        node.setMetadata(PipelineMetadata(images, context))
+    context = acquire_graph(plan.getShape(), preview_scale, seeded)
+    try:
+        for node in pipeline.getNodes():
+            node.setMetadata(PipelineMetadata(images, context))
+
+        # Seed in a fixed order, so pooled graphs are replayed the same way
+        for id in sorted(found):
+            pipeline.getNode(id).presetOutputs([
+                ImageBuilder(context).load_from_buffer(
+                    found[id], prescaled=True)
+            ])
+
+        # Get the output
+        img = plan.evaluate(pipeline)
+        if profile is not None:
+            _profile_gegl(pipeline, plan, profile)
+        if isinstance(img, int):
+            img = ImageBuilder(context).load_from_file(
+                images.image_path_for_id(img))
+        if not isinstance(img, ImageBuilder):
+            raise Exception(
+                f"Output is not an image; got {type(img)}, {repr(img)}")
 
-    outputNode = pipeline.getOutputNode()
-    if outputNode is None:
+        # Save or encode, leaving the node outputs untouched
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        img = img.fork()
+        if viewport is not None:
+            img.crop(*viewport)
+        data = None
+        if target is None:
+            data = img.save_to_bytes(format, quality, progress, cancel)
+        else:
+            img.save_to_file(target).process(
+                progress=progress, cancel=cancel)
+        if profile is not None:
+            profile.set_save_time(
+                time.perf_counter() - start,
+                time.process_time() - start_cpu,
+            )
+
+        if key is not None and target is None:
+            cache.write(key, data)
+        elif key is not None:
+            cache.put(key, target)
+        # Storing renders whole images, which a viewport render is meant to
+        # avoid
+        if intermediates is not None and viewport is None:
+            _store_intermediates(
+                pipeline, plan, hashes, intermediates, seeded)
+    except BaseException:
+        # A failed render leaves the graph half built, so drop it.
+        context.close()
+        raise
+
+    release_graph(plan.getShape(), context, preview_scale, seeded)
+    return data
+
+
+def output_key(
+    pipeline,
+    images: ImageManager,
+    target: Optional[str],
+    viewport: Optional[Rect] = None,
+    preview_scale: float = 1.0,
+    format: str = "png",
+    quality: Optional[int] = None,
+) -> str:
+    """
+    Returns the render cache key process() would use for a pipeline, without
+    rendering it.
+    """
+
+    if isinstance(pipeline, str):
+        pipeline = json.loads(pipeline)
+    pipeline = nodes.deserializePipeline(pipeline, get_template_table())
+    if pipeline.getOutputNode() is None:
         raise Exception("No output node.")
+    plan = compile_pipeline(pipeline)
+
+    hashes = subgraph_hashes(pipeline, plan, images, preview_scale)
+    return render_key(
+        hashes[plan.getOrder()[-1]],
+        target if target is not None else f"out.{format}",
+        viewport,
+        quality,
+    )
+
 
-    # Get the output
-    output = outputNode.getOutputs()[0]
-    img = output.getValue()
-    if isinstance(img, int):
-        img = ImageBuilder(context).load_from_file(
-            images.image_path_for_id(img))
-    if not isinstance(img, ImageBuilder):
-        raise Exception(
-            f"Output is not an image; got {type(img)}, {repr(img)}")
+def estimate_render_size(
+    pipeline,
+    images: ImageManager,
+    viewport: Optional[Rect] = None,
+    preview_scale: float = 1.0,
+) -> int:
+    """
+    Estimates the bytes of memory rendering a pipeline takes, without
+    rendering it.
+
+    Every source the pipeline uses is decoded at full size and may be held
+    at once, as by a composite, and the output is rendered at the size of
+    the largest source at the preview scale, or of a smaller viewport. Sizes
+    are read from the headers of the images, so no GEGL nodes are built;
+    sources whose size can't be read are not counted.
+    """
+
+    if isinstance(pipeline, str):
+        pipeline = json.loads(pipeline)
+
+    source_pixels = 0
+    largest = 0
+    for image_id in {
+        node["values"]["image"] for node in pipeline["nodes"]
+        if node["template"] == "ImgSrc" and "image" in node.get("values", {})
+    }:
+        size = image_size(images.image_path_for_id(image_id))
+        if size is None:
+            continue
+        source_pixels += size[0] * size[1]
+        largest = max(largest, size[0] * size[1])
+
+    output_pixels = largest * preview_scale * preview_scale
+    if viewport is not None:
+        output_pixels = min(output_pixels, viewport[2] * viewport[3])
+    return int((source_pixels + output_pixels) * INTERMEDIATE_PIXEL_SIZE)
+
+
+def bind_source(pipeline: dict, source: int, image_id: int) -> dict:
+    """
+    Returns a copy of a serialized pipeline with the image of one ImgSrc
+    node replaced.
+    """
+
+    nodes = []
+    for node in pipeline["nodes"]:
+        if node["id"] == source:
+            values = dict(node.get("values", {}))
+            values["image"] = image_id
+            node = dict(node, values=values)
+        nodes.append(node)
+    return dict(pipeline, nodes=nodes)
+
+
+def process_batch(
+    pipeline,
+    images: ImageManager,
+    source: int,
+    image_ids: Iterable[int],
+    workers: int = 4,
+    format: str = "png",
+    quality: Optional[int] = None,
+    renderer: Optional[Callable[..., bytes]] = None,
+    **options,
+) -> Iterator[Tuple[int, Optional[bytes], Optional[str]]]:
+    """
+    Renders one pipeline for each of many images.
+
+    The image of the ImgSrc node with the ID source is bound to each image
+    ID in turn, and the renders run on a pool of worker threads. Since the
+    pipelines all have the same shape, they share the compiled plan and the
+    pooled GEGL graphs. Other options are passed on to process().
+
+    Yields (image ID, encoded image, error) as each render finishes, so not
+    necessarily in the order given. A render that fails has no image and
+    the error message instead, and the others go on. Repeated image IDs are
+    only rendered once. At most two renders per worker are queued ahead of
+    the consumer.
+
+    If a renderer is given, it is called instead of process() with the
+    pipeline, the images and the options, and returns the encoded image.
+    """
+
+    if renderer is None:
+        def renderer(pipeline, images, **options):
+            return process(pipeline, images, None, **options)
+
+    if isinstance(pipeline, str):
+        pipeline = json.loads(pipeline)
+
+    source_node = next(
+        (node for node in pipeline["nodes"] if node["id"] == source), None)
+    if source_node is None or source_node["template"] != "ImgSrc":
+        raise ValueError(f"Node {source} is not an ImgSrc node.")
 
-    # Save to file
-    img.save_to_file(target).process()
+    def render(image_id: int) -> Tuple[int, Optional[bytes], Optional[str]]:
+        try:
+            data = renderer(
+                bind_source(pipeline, source, image_id),
+                images,
+                format=format,
+                quality=quality,
+                **options,
+            )
+        except Exception as e:
+            return image_id, None, str(e) or type(e).__name__
+        return image_id, data, None
+
+    def results() -> Iterator[Tuple[int, Optional[bytes], Optional[str]]]:
+        remaining = iter(dict.fromkeys(image_ids))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            pending = set()
+            for image_id in remaining:
+                pending.add(executor.submit(render, image_id))
+                if len(pending) >= workers * 2:
+                    break
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                    for image_id in remaining:
+                        pending.add(executor.submit(render, image_id))
+                        break
+        finally:
+            # Don't start renders nobody will read.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    return results()
+
+
+class _ChunkWriter(io.RawIOBase):
+    """
+    An unseekable stream that collects what is written to it.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(files: Iterable[Tuple[str, bytes]]) -> Iterator[bytes]:
+    """
+    Builds a zip archive from (name, contents) pairs, yielding each part of
+    it as soon as the file is added.
+
+    Images are already compressed, so they are stored as they are.
+    """
+
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+            yield out.take()
+    yield out.take()
 
 
 class PipelineMetadata:
@@ -64,6 +908,25 @@ class PipelineMetadata:
         self.context = context
 
 
+# The template table shared by every pipeline, built on first use.
+_template_table: Optional[
+    nodes.TemplateTable[PipelineUnit, PipelineMetadata]] = None
+
+
+def get_template_table(
+) -> nodes.TemplateTable[PipelineUnit, PipelineMetadata]:
+    """
+    Returns the frozen template table, building it once per process.
+    """
+
+    global _template_table
+    if _template_table is None:
+        table = make_template_table()
+        table.freeze()
+        _template_table = table
+    return _template_table
+
+
 def make_template_table(
 ) -> nodes.TemplateTable[PipelineUnit, PipelineMetadata]:
     table = nodes.TemplateTable()
@@ -101,7 +964,9 @@ def make_template_table(
     def load(arg, meta) -> ImageBuilder:
         val = arg.getValue()
         if isinstance(val, ImageBuilder):
-            return val
+            # The value may be shared with other consumers of the same
+            # output, so build on a fork instead of the original.
+            return val.fork()
         img_path = meta.images.image_path_for_id(val)
         return ImageBuilder(meta.context).load_from_file(img_path)
 
@@ -164,7 +1029,10 @@ def make_template_table(
 
     guassBlur = nodes.NodeTemplate(
         lambda args, meta: [
-            load(args[0], meta).gaussian_blur(args[1], args[2])],
+            load(args[0], meta).gaussian_blur(
+                args[1].getValue(),
+                args[2].getValue(),
+            )],
         [
             nodes.LinkTemplate(None, None, None),
             nodes.LinkTemplate(None, None, "std_dev_x"),
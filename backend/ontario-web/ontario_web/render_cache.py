@@ -0,0 +1,158 @@
+# GNU AGPL v3 License
+# Content-addressed cache of rendered pipeline outputs.
+
+import os
+import shutil
+import tempfile
+import threading
+
+from collections import OrderedDict
+from typing import Optional
+
+
+class RenderCache:
+    """
+    Keeps rendered images on disk, evicting the least recently used ones.
+    """
+
+    # The directory the cached images are stored in.
+    __root: str
+
+    # The maximum total size of the cached images, in bytes.
+    __max_size: int
+
+    # The current total size of the cached images, in bytes.
+    __current_size: int
+
+    # Map between cache keys and file sizes, least recently used first.
+    __entries: "OrderedDict[str, int]"
+
+    # Guards the entries, since requests are handled on several threads.
+    __lock: threading.Lock
+
+    def __init__(self, root: str, max_size: int):
+        os.makedirs(root, exist_ok=True)
+        self.__root = root
+        self.__max_size = max_size
+        self.__current_size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+        # Pick up the images left by a previous run, oldest first.
+        existing = []
+        for name in os.listdir(root):
+            p = os.path.join(root, name)
+            if os.path.isfile(p) and not name.startswith("."):
+                stat = os.stat(p)
+                existing.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(existing):
+            self.__entries[name] = size
+            self.__current_size += size
+        self.__evict()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.__root, key)
+
+    def __evict(self) -> None:
+        """
+        Removes the least recently used images until we are under quota.
+        """
+
+        while self.__current_size > self.__max_size and self.__entries:
+            key, size = self.__entries.popitem(last=False)
+            self.__current_size -= size
+            try:
+                os.remove(self.__path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str, target: str) -> bool:
+        """
+        Copies the cached image for a key to the target path.
+
+        Returns whether the key was in the cache.
+        """
+
+        with self.__lock:
+            if key not in self.__entries:
+                return False
+            self.__entries.move_to_end(key)
+
+            # Copy while holding the lock so the file can't be evicted.
+            try:
+                shutil.copyfile(self.__path(key), target)
+            except FileNotFoundError:
+                self.__current_size -= self.__entries.pop(key)
+                return False
+            return True
+
+    def read(self, key: str) -> Optional[bytes]:
+        """
+        Returns the contents of the cached image for a key, if there is one.
+        """
+
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+
+            # Read while holding the lock so the file can't be evicted.
+            try:
+                with open(self.__path(key), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                self.__current_size -= self.__entries.pop(key)
+                return None
+
+    def put(self, key: str, source: str) -> None:
+        """
+        Stores a copy of the image at the source path under a key.
+        """
+
+        size = os.path.getsize(source)
+        if size > self.__max_size:
+            return
+
+        # Copy to a temporary file first so readers never see partial files.
+        fd, temp = tempfile.mkstemp(dir=self.__root, prefix=".")
+        os.close(fd)
+        shutil.copyfile(source, temp)
+        self.__insert(key, temp, size)
+
+    def write(self, key: str, data: bytes) -> None:
+        """
+        Stores an encoded image under a key.
+        """
+
+        if len(data) > self.__max_size:
+            return
+
+        fd, temp = tempfile.mkstemp(dir=self.__root, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        self.__insert(key, temp, len(data))
+
+    def __insert(self, key: str, temp: str, size: int) -> None:
+        """
+        Moves a finished temporary file into place under a key.
+        """
+
+        with self.__lock:
+            os.replace(temp, self.__path(key))
+            if key in self.__entries:
+                self.__current_size -= self.__entries.pop(key)
+            self.__entries[key] = size
+            self.__current_size += size
+            self.__evict()
+
+    def size(self) -> int:
+        """
+        Returns the current total size of the cached images, in bytes.
+        """
+
+        with self.__lock:
+            return self.__current_size
+
+    def __contains__(self, key: str) -> bool:
+        with self.__lock:
+            return key in self.__entries
@@ -0,0 +1,376 @@
+# GNU AGPL v3 License
+# Long-lived worker processes that render pipelines.
+
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .image_manager import ImageManager
+from .render_cache import RenderCache
+from . import ontario
+from . import processor
+from .ontario import Rect
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Results are handed back through files here, so they stay in memory on
+# systems with a shared memory filesystem.
+_TRANSFER_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# The intermediate cache of this worker process, set when it starts.
+_intermediates = None
+
+
+class RenderTooLarge(Exception):
+    """
+    Raised when a render is estimated to need more memory than it may use.
+    """
+
+
+class RenderCrashed(Exception):
+    """
+    Raised when a render kills the worker process running it.
+    """
+
+
+class ImageSnapshot:
+    """
+    Stands in for the image manager in worker processes.
+
+    Only the images a pipeline uses are looked up, before it is sent off.
+    """
+
+    # Map between image IDs and their paths and content hashes.
+    __images: Dict[str, Tuple[str, str]]
+
+    def __init__(self, images: Dict[str, Tuple[str, str]]):
+        self.__images = images
+
+    def image_path_for_id(self, image_id: int) -> str:
+        """
+        Returns the image path for the given image ID.
+        """
+
+        return self.__images[str(image_id)][0]
+
+    def content_hash_for_id(self, image_id: int) -> str:
+        """
+        Returns the hash of the contents of the image with the given ID.
+        """
+
+        return self.__images[str(image_id)][1]
+
+
+def snapshot_images(
+    pipeline: dict, images: ImageManager
+) -> Dict[str, Tuple[str, str]]:
+    """
+    Looks up the paths and content hashes of the images a pipeline uses.
+
+    Raises a KeyError if one of them does not exist.
+    """
+
+    used = {}
+    for node in pipeline["nodes"]:
+        if node["template"] == "ImgSrc" and "image" in node.get("values", {}):
+            image_id = node["values"]["image"]
+            used[str(image_id)] = (
+                images.image_path_for_id(image_id),
+                images.content_hash_for_id(image_id),
+            )
+    return used
+
+
+def _start_worker(
+    address_limit: int,
+    intermediate_cache_size: int,
+    source_cache_size: int,
+) -> None:
+    """
+    Warms up a new worker process and limits its address space.
+    """
+
+    global _intermediates
+
+    processor.get_template_table()
+    ontario.source_cache.set_max_size(source_cache_size)
+    _intermediates = processor.IntermediateCache(intermediate_cache_size)
+
+    # This counts reserved address space, such as malloc arenas and thread
+    # stacks, and GLib aborts rather than failing allocations gracefully, so
+    # it is only a last resort against runaway workers.
+    if address_limit > 0 and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (address_limit, address_limit))
+
+
+def _render(
+    pipeline: dict,
+    images: Dict[str, Tuple[str, str]],
+    viewport: Optional[Rect],
+    preview_scale: float,
+    format: str,
+    quality: Optional[int],
+    profile: bool,
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Renders a pipeline in a worker process.
+
+    Returns the path of a file holding the encoded image, which the caller
+    removes, and the profile if one was asked for.
+    """
+
+    report = processor.ProfileReport() if profile else None
+    data = processor.process(
+        pipeline,
+        ImageSnapshot(images),
+        None,
+        profile=report,
+        intermediates=_intermediates,
+        viewport=viewport,
+        preview_scale=preview_scale,
+        format=format,
+        quality=quality,
+    )
+
+    fd, p = tempfile.mkstemp(dir=_TRANSFER_DIR, prefix="ontario-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return p, report.to_json() if report is not None else None
+
+
+class RenderPool:
+    """
+    Renders pipelines in a pool of long-lived worker processes.
+
+    Renders never run in the request workers, so a huge render can't block
+    them or leave their memory inflated. The workers keep the template table
+    and the decoded source and intermediate images between renders, and are
+    replaced after a number of renders to give back what they grew by.
+
+    Renders estimated to need more memory than the limit are refused before
+    they are sent off. A worker that crashes breaks the whole pool, failing
+    the renders of every worker, so those are run again each in a process of
+    their own: only a render that crashes by itself fails.
+    """
+
+    # The number of worker processes.
+    __workers: int
+
+    # The number of tasks after which a worker is replaced, or 0 for never.
+    __max_tasks: int
+
+    # The memory a render may be estimated to need, in bytes, or 0 for any.
+    __memory_limit: int
+
+    # The address space limit of each worker, in bytes, or 0 for none.
+    __address_limit: int
+
+    # The sizes of the intermediate and source caches of each worker.
+    __cache_sizes: Tuple[int, int]
+
+    # The worker processes, started on first use.
+    __executor: Optional[ProcessPoolExecutor]
+
+    # Guards the executor.
+    __lock: threading.Lock
+
+    def __init__(
+        self,
+        workers: int,
+        max_tasks: int = 0,
+        memory_limit: int = 0,
+        intermediate_cache_size: int = 256 * 1024 * 1024,
+        source_cache_size: int = 256 * 1024 * 1024,
+        address_limit: int = 0,
+    ):
+        self.__workers = workers
+        self.__max_tasks = max_tasks
+        self.__memory_limit = memory_limit
+        self.__address_limit = address_limit
+        self.__cache_sizes = (intermediate_cache_size, source_cache_size)
+        self.__executor = None
+        self.__lock = threading.Lock()
+
+    def __start(self, isolated: bool = False) -> ProcessPoolExecutor:
+        options = {}
+        # Replacing workers needs Python 3.11; older ones keep their workers.
+        max_tasks = 0 if isolated else self.__max_tasks
+        if max_tasks > 0 and sys.version_info >= (3, 11):
+            options["max_tasks_per_child"] = max_tasks
+        return ProcessPoolExecutor(
+            max_workers=1 if isolated else self.__workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_start_worker,
+            initargs=(self.__address_limit, *self.__cache_sizes),
+            **options,
+        )
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """
+        Runs a module level function in a worker process.
+        """
+
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = self.__start()
+            try:
+                return self.__executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # A worker died, taking the pool with it; start a new one.
+                self.__executor = self.__start()
+                return self.__executor.submit(fn, *args)
+
+    def isolate(self, fn: Callable, *args) -> Future:
+        """
+        Runs a module level function in a worker process of its own, which
+        exits once it is done.
+        """
+
+        executor = self.__start(isolated=True)
+        future = executor.submit(fn, *args)
+        executor.shutdown(wait=False)
+        return future
+
+    def run(self, fn: Callable, *args) -> Any:
+        """
+        Runs a module level function in a worker process and returns its
+        result.
+
+        If the pool breaks while it runs, the function is run again in a
+        process of its own, and a RenderCrashed is raised if that one dies as
+        well.
+        """
+
+        try:
+            return self.submit(fn, *args).result()
+        except BrokenProcessPool:
+            pass
+        try:
+            return self.isolate(fn, *args).result()
+        except BrokenProcessPool:
+            raise RenderCrashed("The render crashed its worker process.")
+
+    def check_size(
+        self,
+        pipeline,
+        images: ImageManager,
+        viewport: Optional[Rect] = None,
+        preview_scale: float = 1.0,
+    ) -> None:
+        """
+        Raises a RenderTooLarge if a pipeline is estimated to need more memory
+        than a render may use, see processor.estimate_render_size().
+        """
+
+        if self.__memory_limit <= 0:
+            return
+        size = processor.estimate_render_size(
+            pipeline, images, viewport, preview_scale)
+        if size > self.__memory_limit:
+            raise RenderTooLarge(
+                f"The render needs about {size >> 20} MiB, more than the "
+                f"{self.__memory_limit >> 20} MiB allowed.")
+
+    def __render(
+        self,
+        pipeline,
+        images: ImageManager,
+        viewport: Optional[Rect],
+        preview_scale: float,
+        format: str,
+        quality: Optional[int],
+        profile: bool,
+    ) -> Tuple[bytes, Optional[Dict[str, Any]]]:
+        if isinstance(pipeline, str):
+            pipeline = json.loads(pipeline)
+
+        used = snapshot_images(pipeline, images)
+        self.check_size(pipeline, images, viewport, preview_scale)
+        p, report = self.run(
+            _render,
+            pipeline,
+            used,
+            viewport,
+            preview_scale,
+            format,
+            quality,
+            profile,
+        )
+        try:
+            with open(p, "rb") as f:
+                return f.read(), report
+        finally:
+            os.remove(p)
+
+    def render(
+        self,
+        pipeline,
+        images: ImageManager,
+        cache: Optional[RenderCache] = None,
+        viewport: Optional[Rect] = None,
+        preview_scale: float = 1.0,
+        format: str = "png",
+        quality: Optional[int] = None,
+    ) -> bytes:
+        """
+        Renders a pipeline, like processor.process() without a target.
+
+        The images the pipeline uses must exist, or a KeyError is raised. If
+        a render cache is given, identical pipelines are only rendered once.
+        Raises a RenderTooLarge or RenderCrashed if the render is refused or
+        crashes.
+        """
+
+        key = None
+        if cache is not None:
+            key = processor.output_key(
+                pipeline, images, None, viewport, preview_scale, format,
+                quality)
+            data = cache.read(key)
+            if data is not None:
+                return data
+
+        data, _ = self.__render(
+            pipeline, images, viewport, preview_scale, format, quality,
+            False)
+        if key is not None:
+            cache.write(key, data)
+        return data
+
+    def render_profiled(
+        self,
+        pipeline,
+        images: ImageManager,
+        viewport: Optional[Rect] = None,
+        preview_scale: float = 1.0,
+        format: str = "png",
+        quality: Optional[int] = None,
+    ) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Renders a pipeline without caches, returning the image and the JSON
+        form of its profile report.
+        """
+
+        return self.__render(
+            pipeline, images, viewport, preview_scale, format, quality, True)
+
+    def shutdown(self) -> None:
+        """
+        Stops the worker processes, waiting for running renders to finish.
+        """
+
+        with self.__lock:
+            executor = self.__executor
+            self.__executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -40,6 +40,10 @@ def app():
 
     yield app
 
+    # Every app starts its own worker processes, so stop them with it
+    app.extensions["job_queue"].shutdown()
+    app.extensions["render_pool"].shutdown()
+
 
 @pytest.fixture
 def client(app):
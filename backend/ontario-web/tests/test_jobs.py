@@ -0,0 +1,65 @@
+# GNU AGPL v3 License
+
+import time
+
+
+def test_jobs(client, image_ids):
+    image1_id, image2_id = image_ids
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": image1_id}},
+            {"id": 1, "template": "ImgSrc", "values": {"image": image2_id}},
+            {"id": 2, "template": "CompOver"},
+            {"id": 3, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 4, "from": 0, "to": 2, "fromIndex": 0, "toIndex": 0},
+            {"id": 5, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 1},
+            {"id": 6, "from": 2, "to": 3, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 3,
+    }
+
+    response = client.post('/api/jobs', json=pipeline)
+    assert response.status_code == 202
+    job_id = response.json["id"]
+
+    # Poll until the job is finished
+    deadline = time.time() + 60
+    while True:
+        response = client.get(f'/api/jobs/{job_id}')
+        assert response.status_code == 200
+        status = response.json
+        if status["status"] not in ("queued", "running"):
+            break
+        assert time.time() < deadline
+        time.sleep(0.1)
+
+    assert status["status"] == "done", status["error"]
+    assert status["progress"] == 1.0
+
+    response = client.get(f'/api/jobs/{job_id}/result')
+    assert response.status_code == 200
+    assert response.mimetype in ("image/webp", "image/png")
+    assert response.data
+
+
+def test_jobs_errors(client):
+    response = client.get('/api/jobs/nonexistent')
+    assert response.status_code == 404
+    response = client.get(f'/api/jobs/{"0" * 32}/result')
+    assert response.status_code == 404
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": 123456}},
+            {"id": 1, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 2, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 1,
+    }
+    response = client.post('/api/jobs', json=pipeline)
+    assert response.status_code == 404
@@ -0,0 +1,321 @@
+# GNU AGPL v3 License
+# Test the libnodepy-style pipeline engine
+
+import pytest
+import threading
+
+from ontario_web import nodes
+
+
+def make_counting_table(calls):
+    """
+    Creates a small arithmetic template table that records every node run.
+    """
+
+    table = nodes.TemplateTable()
+
+    def record(name, value):
+        calls.append(name)
+        return value
+
+    numNode = nodes.NodeTemplate(
+        lambda args, meta: [record("Num", args[0].getValue())],
+        [
+            nodes.LinkTemplate(None, 0, "value")
+        ],
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        None
+    )
+    numNode.insertNamedInput("value", 0)
+    table.addTemplate("Num", numNode)
+
+    doubleNode = nodes.NodeTemplate(
+        lambda args, meta: [record("Double", args[0].getValue() * 2)],
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        None
+    )
+    table.addTemplate("Double", doubleNode)
+
+    addNode = nodes.NodeTemplate(
+        lambda args, meta: [
+            record("Add", args[0].getValue() + args[1].getValue())],
+        [
+            nodes.LinkTemplate(None, 0, None),
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        None
+    )
+    table.addTemplate("Add", addNode)
+
+    outNode = nodes.NodeTemplate(
+        lambda args, meta: [args[0].getValue()],
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        None
+    )
+    table.addTemplate("Out", outNode)
+
+    return table
+
+
+def diamond_pipeline(value=3):
+    """
+    A source that fans out to two branches, which are added back together.
+    """
+
+    return {
+        "nodes": [
+            {"id": 1, "template": "Num", "values": {"value": value}},
+            {"id": 2, "template": "Double"},
+            {"id": 3, "template": "Double"},
+            {"id": 4, "template": "Add"},
+            {"id": 5, "template": "Out"},
+        ],
+        "links": [
+            {"id": 6, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 0},
+            {"id": 7, "from": 1, "to": 3, "fromIndex": 0, "toIndex": 0},
+            {"id": 8, "from": 2, "to": 4, "fromIndex": 0, "toIndex": 0},
+            {"id": 9, "from": 3, "to": 4, "fromIndex": 0, "toIndex": 1},
+            {"id": 10, "from": 4, "to": 5, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 5,
+    }
+
+
+def test_evaluate_runs_each_node_once():
+    calls = []
+    pipeline = nodes.deserializePipeline(
+        diamond_pipeline(), make_counting_table(calls))
+
+    assert pipeline.evaluate() == 12
+    assert calls.count("Num") == 1
+    assert calls.count("Double") == 2
+    assert calls.count("Add") == 1
+
+
+def test_evaluate_reuses_clean_outputs():
+    calls = []
+    pipeline = nodes.deserializePipeline(
+        diamond_pipeline(), make_counting_table(calls))
+
+    assert pipeline.evaluate() == 12
+    assert pipeline.evaluate() == 12
+    assert calls.count("Num") == 1
+
+    pipeline.invalidate()
+    assert pipeline.evaluate() == 12
+    assert calls.count("Num") == 2
+
+
+def chain_pipeline(length, value=1):
+    """
+    A long chain of doubling nodes.
+    """
+
+    serialized = {
+        "nodes": [{"id": 1, "template": "Num", "values": {"value": value}}],
+        "links": [],
+        "output": length + 2,
+    }
+    for i in range(2, length + 2):
+        serialized["nodes"].append({"id": i, "template": "Double"})
+    serialized["nodes"].append({"id": length + 2, "template": "Out"})
+    for i in range(1, length + 2):
+        serialized["links"].append({
+            "from": i, "to": i + 1, "fromIndex": 0, "toIndex": 0
+        })
+    return serialized
+
+
+def test_compile_rejects_cycles():
+    serialized = diamond_pipeline()
+    serialized["links"].append(
+        {"id": 11, "from": 4, "to": 2, "fromIndex": 0, "toIndex": 0})
+    pipeline = nodes.deserializePipeline(serialized, make_counting_table([]))
+
+    with pytest.raises(ValueError):
+        pipeline.compile()
+
+
+def test_compile_deep_pipeline():
+    calls = []
+    pipeline = nodes.deserializePipeline(
+        chain_pipeline(5000), make_counting_table(calls))
+
+    plan = pipeline.compile()
+    assert plan.getOrder()[0] == 1
+    assert plan.getOrder()[-1] == 5002
+    assert plan.evaluate(pipeline) == 2 ** 5000
+    assert len(calls) == 5001
+
+
+def test_compiled_plan_is_reusable():
+    table = make_counting_table([])
+    first = nodes.deserializePipeline(diamond_pipeline(3), table)
+    second = nodes.deserializePipeline(diamond_pipeline(5), table)
+
+    plan = first.compile()
+    assert first.shape() == second.shape()
+    assert plan.evaluate(first) == 12
+    assert plan.evaluate(second) == 20
+
+    with pytest.raises(ValueError):
+        plan.evaluate(
+            nodes.deserializePipeline(chain_pipeline(3), table))
+
+
+def test_parallel_evaluation():
+    calls = []
+    pipeline = nodes.deserializePipeline(
+        diamond_pipeline(), make_counting_table(calls))
+
+    plan = pipeline.compile()
+    assert plan.evaluate(pipeline, workers=4) == 12
+    assert calls.count("Num") == 1
+    assert calls.count("Double") == 2
+    assert calls.count("Add") == 1
+
+
+def test_parallel_evaluation_runs_branches_concurrently():
+    # Both branches must be running at once to get past the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+    table = make_counting_table([])
+
+    def waitThenForward(args, meta):
+        barrier.wait()
+        return [args[0].getValue()]
+
+    waitNode = nodes.NodeTemplate(
+        waitThenForward,
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        [
+            nodes.LinkTemplate(None, 0, None)
+        ],
+        None
+    )
+    table.addTemplate("Wait", waitNode)
+
+    serialized = diamond_pipeline()
+    serialized["nodes"][1]["template"] = "Wait"
+    serialized["nodes"][2]["template"] = "Wait"
+    pipeline = nodes.deserializePipeline(serialized, table)
+
+    assert pipeline.compile().evaluate(pipeline, workers=2) == 6
+
+
+def test_incremental_evaluation():
+    calls = []
+    serialized = {
+        "nodes": [
+            {"id": 1, "template": "Num", "values": {"value": 3}},
+            {"id": 2, "template": "Double"},
+            {"id": 3, "template": "Num", "values": {"value": 4}},
+            {"id": 4, "template": "Add"},
+            {"id": 5, "template": "Out"},
+        ],
+        "links": [
+            {"id": 6, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 0},
+            {"id": 7, "from": 2, "to": 4, "fromIndex": 0, "toIndex": 0},
+            {"id": 8, "from": 3, "to": 4, "fromIndex": 0, "toIndex": 1},
+            {"id": 9, "from": 4, "to": 5, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 5,
+    }
+    pipeline = nodes.deserializePipeline(
+        serialized, make_counting_table(calls))
+    assert pipeline.evaluate() == 10
+
+    # Only the changed source and the nodes below it run again.
+    calls.clear()
+    pipeline.setValues(3, {"value": 10})
+    assert pipeline.evaluate() == 16
+    assert calls == ["Num", "Add"]
+
+    calls.clear()
+    pipeline.getNode(1).setValue("value", 1)
+    assert pipeline.evaluate() == 12
+    assert calls == ["Num", "Double", "Add"]
+
+
+def test_nodes_own_their_values():
+    pipeline = nodes.Pipeline(make_counting_table([]))
+    a = pipeline.createNode("Num", None)
+    b = pipeline.createNode("Num", None)
+    a.setValue("value", 5)
+    assert a.getValues() == {"value": 5}
+    assert b.getValues() == {}
+
+    # The deserialized JSON is left alone.
+    serialized = diamond_pipeline()
+    pipeline = nodes.deserializePipeline(
+        serialized, make_counting_table([]))
+    pipeline.getNode(1).setValue("value", 7)
+    assert serialized["nodes"][0]["values"] == {"value": 3}
+
+
+def test_tracing():
+    tracer = nodes.CollectingTracer()
+    pipeline = nodes.deserializePipeline(
+        diamond_pipeline(), make_counting_table([]))
+    pipeline.setTracer(tracer)
+
+    pipeline.evaluate()
+    spans = tracer.getSpans()
+    assert [span.id for span in spans] == [1, 2, 3, 4, 5]
+    assert spans[0].template == "Num"
+    assert not any(span.cacheHit for span in spans)
+    assert all(span.wallTime >= 0 for span in spans)
+    assert all(span.cpuTime >= 0 for span in spans)
+
+    # Evaluating again reuses every cached output.
+    pipeline.evaluate()
+    spans = tracer.getSpans()[5:]
+    assert len(spans) == 5
+    assert all(span.cacheHit for span in spans)
+
+
+def test_frozen_template_table():
+    table = make_counting_table([])
+    table.freeze()
+    assert table.isFrozen()
+
+    with pytest.raises(RuntimeError):
+        table.addTemplate("Num", table.getTemplate("Num"))
+
+    pipeline = nodes.deserializePipeline(diamond_pipeline(), table)
+    assert pipeline.getNode(1).getNodeTemplate() is table.getTemplate("Num")
+    assert pipeline.evaluate() == 12
+
+
+def test_preset_outputs_skip_upstream():
+    calls = []
+    pipeline = nodes.deserializePipeline(
+        diamond_pipeline(), make_counting_table(calls))
+
+    # Seeding one branch means only the other branch needs the source.
+    pipeline.getNode(2).presetOutputs([100])
+    assert pipeline.evaluate() == 106
+    assert calls == ["Num", "Double", "Add"]
+
+    calls.clear()
+    pipeline = nodes.deserializePipeline(
+        diamond_pipeline(), make_counting_table(calls))
+    pipeline.getNode(4).presetOutputs([7])
+    assert pipeline.evaluate() == 7
+    assert calls == []
@@ -1,5 +1,13 @@
 # GNU AGPL v3 License
 
+import io
+import json
+import zipfile
+
+from os import path
+
+from ontario_web import nodes, processor
+
 
 def test_process(client, image_ids):
     image1_id, image2_id = image_ids
@@ -123,3 +131,386 @@ def test_non_sequential(client, image_ids):
     # Process the pipeline
     response = client.post('/api/process', json=pipeline)
     assert response.status_code == 200
+
+
+def test_process_profile(client, image_ids):
+    image1_id, image2_id = image_ids
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": image1_id}},
+            {"id": 1, "template": "ImgSrc", "values": {"image": image2_id}},
+            {"id": 2, "template": "CompOver"},
+            {"id": 3, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 4, "from": 0, "to": 2, "fromIndex": 0, "toIndex": 0},
+            {"id": 5, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 1},
+            {"id": 6, "from": 2, "to": 3, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 3,
+    }
+
+    response = client.post('/api/process?profile=1', json=pipeline)
+    assert response.status_code == 200
+
+    profile = json.loads(response.headers["X-Ontario-Profile"])
+    assert {node["id"] for node in profile["nodes"]} == {0, 1, 2, 3}
+    assert "CompOver" in profile["templates"]
+    assert profile["save"]["wall"] >= 0
+
+
+def test_process_cached(client, image_ids):
+    image1_id, image2_id = image_ids
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": image1_id}},
+            {"id": 1, "template": "ImgSrc", "values": {"image": image2_id}},
+            {"id": 2, "template": "CompOver"},
+            {"id": 3, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 4, "from": 0, "to": 2, "fromIndex": 0, "toIndex": 0},
+            {"id": 5, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 1},
+            {"id": 6, "from": 2, "to": 3, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 3,
+    }
+
+    # The second request is served from the render cache
+    first = client.post('/api/process', json=pipeline)
+    second = client.post('/api/process', json=pipeline)
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert first.data == second.data
+
+
+def test_intermediate_cache():
+    cache = processor.IntermediateCache(100)
+    cache.put("a", "buffer a", 40)
+    cache.put("b", "buffer b", 40)
+    assert cache.get("a") == "buffer a"
+
+    # "b" is now the least recently used entry.
+    cache.put("c", "buffer c", 40)
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.get("c") == "buffer c"
+    assert cache.size() == 80
+
+    assert not cache.fits(200)
+    cache.put("d", "buffer d", 200)
+    assert "d" not in cache
+
+    assert not cache.seen("e")
+    assert cache.seen("e")
+
+
+class LocalImages:
+    """
+    Serves the test assets by ID without the database.
+    """
+
+    def image_path_for_id(self, image_id):
+        return path.join(
+            path.dirname(__file__), "assets", f"test{image_id}.png")
+
+    def content_hash_for_id(self, image_id):
+        return f"test{image_id}"
+
+
+def blurred_pipeline():
+    return {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": 1}},
+            {"id": 1, "template": "GaussBlur",
+             "values": {"std_dev_x": 2.0, "std_dev_y": 2.0}},
+            {"id": 2, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 3, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+            {"id": 4, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 2,
+    }
+
+
+def test_intermediates_only_reused():
+    intermediates = processor.IntermediateCache(256 * 1024 * 1024)
+
+    # The blur is only stored once a second request renders it too
+    processor.process(
+        blurred_pipeline(), LocalImages(), None, intermediates=intermediates)
+    assert intermediates.size() == 0
+    processor.process(
+        blurred_pipeline(), LocalImages(), None, intermediates=intermediates)
+    assert intermediates.size() > 0
+
+
+def test_estimate_render_size():
+    pixels = 250 * 250
+
+    # The decoded source and the output
+    size = processor.estimate_render_size(blurred_pipeline(), LocalImages())
+    assert size == 2 * pixels * processor.INTERMEDIATE_PIXEL_SIZE
+
+    # A composite holds both of its sources at once
+    composite = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": 1}},
+            {"id": 1, "template": "ImgSrc", "values": {"image": 2}},
+            {"id": 2, "template": "CompOver"},
+            {"id": 3, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 4, "from": 0, "to": 2, "fromIndex": 0, "toIndex": 0},
+            {"id": 5, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 1},
+            {"id": 6, "from": 2, "to": 3, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 3,
+    }
+    size = processor.estimate_render_size(composite, LocalImages())
+    assert size == 3 * pixels * processor.INTERMEDIATE_PIXEL_SIZE
+
+    # A viewport only shrinks the output
+    size = processor.estimate_render_size(
+        composite, LocalImages(), viewport=(0, 0, 10, 10))
+    assert size == (2 * pixels + 100) * processor.INTERMEDIATE_PIXEL_SIZE
+
+
+def test_intermediates_shared_prefix():
+    intermediates = processor.IntermediateCache(256 * 1024 * 1024)
+
+    # Rendering the blur twice stores it
+    for _ in range(2):
+        processor.process(
+            blurred_pipeline(), LocalImages(), None,
+            intermediates=intermediates)
+
+    inverted = blurred_pipeline()
+    inverted["nodes"].insert(2, {"id": 5, "template": "Invert"})
+    inverted["links"] = [
+        {"id": 3, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+        {"id": 6, "from": 1, "to": 5, "fromIndex": 0, "toIndex": 0},
+        {"id": 4, "from": 5, "to": 2, "fromIndex": 0, "toIndex": 0},
+    ]
+
+    # The blurred prefix is seeded from the cache, so the source is not
+    # even loaded
+    tracer = nodes.CollectingTracer()
+    data = processor.process(
+        inverted, LocalImages(), None, tracer=tracer,
+        intermediates=intermediates)
+    hits = {span.id: span.cacheHit for span in tracer.getSpans()}
+    assert hits[1]
+    assert not hits[5]
+    assert 0 not in hits
+
+    assert data == processor.process(inverted, LocalImages(), None)
+
+
+def test_process_viewport(client, image_ids):
+    image1_id, _ = image_ids
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": image1_id}},
+            {"id": 1, "template": "Invert"},
+            {"id": 2, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 3, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+            {"id": 4, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 2,
+    }
+
+    response = client.post(
+        '/api/process?x=0&y=0&width=16&height=16', json=pipeline)
+    assert response.status_code == 200
+
+    # A partial viewport is rejected
+    response = client.post('/api/process?x=0&y=0', json=pipeline)
+    assert response.status_code == 400
+
+
+def test_process_preview(client, image_ids):
+    image1_id, _ = image_ids
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": image1_id}},
+            {"id": 1, "template": "GaussBlur",
+             "values": {"std_dev_x": 8.0, "std_dev_y": 8.0}},
+            {"id": 2, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 3, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+            {"id": 4, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 2,
+    }
+
+    preview = client.post('/api/process?preview=0.25', json=pipeline)
+    full = client.post('/api/process', json=pipeline)
+    assert preview.status_code == 200
+    assert full.status_code == 200
+    assert preview.data != full.data
+
+    response = client.post('/api/process?preview=2', json=pipeline)
+    assert response.status_code == 400
+
+
+def test_graph_pool():
+    shape = ((), (), 0)
+    context = processor.acquire_graph(shape)
+    processor.release_graph(shape, context)
+
+    assert processor.acquire_graph(shape) is context
+    assert processor.acquire_graph(shape) is not context
+
+
+def test_graph_pool_seeded():
+    intermediates = processor.IntermediateCache(256 * 1024 * 1024)
+    expected = processor.process(blurred_pipeline(), LocalImages(), None)
+
+    # Seeded renders build the blur as a buffer source, so they take their
+    # graphs from the pool apart from unseeded ones
+    for _ in range(3):
+        assert processor.process(
+            blurred_pipeline(), LocalImages(), None,
+            intermediates=intermediates) == expected
+        assert processor.process(
+            blurred_pipeline(), LocalImages(), None) == expected
+
+    seeded = {key[2] for key in processor._graph_pool}
+    assert frozenset() in seeded
+    assert frozenset({1}) in seeded
+
+
+def test_process_in_memory(client, image_ids):
+    image1_id, _ = image_ids
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": image1_id}},
+            {"id": 1, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 2, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 1,
+    }
+
+    response = client.post('/api/process?quality=80', json=pipeline)
+    assert response.status_code == 200
+    assert response.mimetype in ("image/webp", "image/png")
+    assert response.data
+
+    response = client.post('/api/process?quality=500', json=pipeline)
+    assert response.status_code == 400
+
+
+def test_process_batch(client, image_ids):
+    image1_id, image2_id = image_ids
+
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": image1_id}},
+            {"id": 1, "template": "Invert"},
+            {"id": 2, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 3, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+            {"id": 4, "from": 1, "to": 2, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 2,
+    }
+
+    response = client.post('/api/process_batch', json={
+        "pipeline": pipeline,
+        "source": 0,
+        "images": [image1_id, image2_id],
+    })
+    assert response.status_code == 200
+    assert response.mimetype == "application/zip"
+
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    names = {path.splitext(name)[0] for name in archive.namelist()}
+    assert names == {str(image1_id), str(image2_id)}
+    for name in archive.namelist():
+        assert archive.read(name)
+
+    # The source has to be an ImgSrc node
+    response = client.post('/api/process_batch', json={
+        "pipeline": pipeline,
+        "source": 1,
+        "images": [image1_id],
+    })
+    assert response.status_code == 400
+
+    response = client.post('/api/process_batch', json={
+        "pipeline": pipeline,
+        "source": 0,
+        "images": [image1_id, 123456],
+    })
+    assert response.status_code == 404
+
+    response = client.post('/api/process_batch', json={
+        "pipeline": pipeline,
+        "source": 0,
+        "images": [image1_id, image1_id],
+    })
+    assert response.status_code == 400
+
+
+def test_process_batch_errors():
+    pipeline = {
+        "nodes": [
+            {"id": 0, "template": "ImgSrc", "values": {"image": 0}},
+            {"id": 1, "template": "ImgOut"},
+        ],
+        "links": [
+            {"id": 2, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0},
+        ],
+        "output": 1,
+    }
+
+    def renderer(pipeline, images, **options):
+        image_id = pipeline["nodes"][0]["values"]["image"]
+        if image_id == 2:
+            raise Exception("broken image")
+        return str(image_id).encode()
+
+    # A failed render is reported and the others still finish
+    results = processor.process_batch(
+        pipeline, None, 0, [0, 1, 2, 3, 1], workers=2, renderer=renderer)
+    results = sorted(results, key=lambda result: result[0])
+    assert results == [
+        (0, b"0", None),
+        (1, b"1", None),
+        (2, None, "broken image"),
+        (3, b"3", None),
+    ]
+
+
+def test_viewport_renders_only_the_rect():
+    intermediates = processor.IntermediateCache(256 * 1024 * 1024)
+
+    # Storing intermediates would render the whole blurred image, so a
+    # viewport render never does, however often it is repeated
+    for _ in range(3):
+        data = processor.process(
+            blurred_pipeline(),
+            LocalImages(),
+            None,
+            intermediates=intermediates,
+            viewport=(4, 4, 16, 8),
+        )
+        assert intermediates.size() == 0
+
+    # The PNG header holds the size of the image
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    assert int.from_bytes(data[16:20], "big") == 16
+    assert int.from_bytes(data[20:24], "big") == 8
@@ -0,0 +1,71 @@
+# GNU AGPL v3 License
+# Test the render cache
+
+from os import path
+
+from ontario_web.render_cache import RenderCache
+
+
+def write_file(p, size):
+    with open(p, "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_get_and_put(tmp_path):
+    cache = RenderCache(str(tmp_path / "cache"), 1000)
+    source = str(tmp_path / "source.webp")
+    target = str(tmp_path / "target.webp")
+    write_file(source, 100)
+
+    assert not cache.get("key", target)
+    cache.put("key", source)
+    assert cache.get("key", target)
+    assert path.getsize(target) == 100
+    assert cache.size() == 100
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = RenderCache(str(tmp_path / "cache"), 250)
+    source = str(tmp_path / "source.webp")
+    target = str(tmp_path / "target.webp")
+    write_file(source, 100)
+
+    cache.put("a", source)
+    cache.put("b", source)
+    assert cache.get("a", target)
+
+    # "b" is now the least recently used entry.
+    cache.put("c", source)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.size() == 200
+
+    # Entries larger than the whole cache are never stored.
+    write_file(source, 300)
+    cache.put("d", source)
+    assert "d" not in cache
+
+
+def test_reloads_existing_entries(tmp_path):
+    source = str(tmp_path / "source.webp")
+    write_file(source, 100)
+    RenderCache(str(tmp_path / "cache"), 1000).put("a", source)
+
+    cache = RenderCache(str(tmp_path / "cache"), 1000)
+    assert "a" in cache
+    assert cache.size() == 100
+
+
+def test_read_and_write(tmp_path):
+    cache = RenderCache(str(tmp_path / "cache"), 1000)
+
+    assert cache.read("key") is None
+    cache.write("key", b"image")
+    assert cache.read("key") == b"image"
+    assert cache.size() == 5
+
+    # Entries written from memory can be copied out to files, too.
+    target = str(tmp_path / "target.webp")
+    assert cache.get("key", target)
+    assert path.getsize(target) == 5
@@ -0,0 +1,88 @@
+# GNU AGPL v3 License
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from ontario_web import render_pool
+
+from .test_process import LocalImages, blurred_pipeline
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 11), reason="needs max_tasks_per_child")
+def test_recycle():
+    pool = render_pool.RenderPool(1, max_tasks=1)
+    try:
+        first = pool.submit(os.getpid).result()
+        second = pool.submit(os.getpid).result()
+        assert first != second
+    finally:
+        pool.shutdown()
+
+
+def test_address_limit():
+    pool = render_pool.RenderPool(1, address_limit=1024 * 1024 * 1024)
+    try:
+        with pytest.raises(MemoryError):
+            pool.submit(bytearray, 2 * 1024 * 1024 * 1024).result()
+
+        # The worker is still usable afterwards
+        assert pool.submit(os.getpid).result() != os.getpid()
+    finally:
+        pool.shutdown()
+
+
+def test_memory_limit():
+    pool = render_pool.RenderPool(1, memory_limit=1024)
+    try:
+        # Refused before a worker is even started
+        with pytest.raises(render_pool.RenderTooLarge):
+            pool.render(blurred_pipeline(), LocalImages())
+
+        # A small enough viewport doesn't make up for decoding the source
+        with pytest.raises(render_pool.RenderTooLarge):
+            pool.render(
+                blurred_pipeline(), LocalImages(), viewport=(0, 0, 1, 1))
+    finally:
+        pool.shutdown()
+
+
+def test_crash():
+    pool = render_pool.RenderPool(4)
+    try:
+        # Warm up the pool, so the renders below run at once
+        pool.run(os.getpid)
+
+        results = {}
+
+        def run(name, fn, *args):
+            try:
+                results[name] = pool.run(fn, *args)
+            except Exception as e:
+                results[name] = e
+
+        threads = [
+            threading.Thread(target=run, args=(i, time.sleep, 2))
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Kill a worker while the others are rendering
+        time.sleep(0.5)
+        run("crash", os._exit, 1)
+        for thread in threads:
+            thread.join()
+
+        # Only the render that crashed by itself fails
+        assert isinstance(results.pop("crash"), render_pool.RenderCrashed)
+        assert results == {0: None, 1: None, 2: None}
+
+        # The pool is started again afterwards
+        assert pool.run(os.getpid) != os.getpid()
+    finally:
+        pool.shutdown()
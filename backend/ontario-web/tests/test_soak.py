@@ -0,0 +1,84 @@
+# GNU AGPL v3 License
+
+import os
+
+import pytest
+
+from ontario_web import processor
+
+from .test_process import LocalImages
+
+# Thousands of renders take minutes, so these only run when asked for, with
+# scripts/pytest_soak.sh or ONTARIO_SOAK=1.
+pytestmark = [
+    pytest.mark.skipif(
+        os.environ.get("ONTARIO_SOAK") != "1",
+        reason="set ONTARIO_SOAK=1 to run soak tests"),
+    pytest.mark.skipif(
+        not os.path.exists("/proc/self/statm"), reason="needs /proc"),
+]
+
+RENDERS = 2000
+
+# How much the resident set may grow once the caches have warmed up.
+MAX_GROWTH = 32 * 1024 * 1024
+
+
+def resident_set_size():
+    """
+    Returns the current resident set size of this process, in bytes.
+    """
+
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def chain_pipeline(length, std_dev):
+    """
+    A blurred source followed by a chain of inverts, so every length is a
+    different pipeline shape.
+    """
+
+    nodes = [
+        {"id": 0, "template": "ImgSrc", "values": {"image": 1}},
+        {"id": 1, "template": "GaussBlur",
+         "values": {"std_dev_x": std_dev, "std_dev_y": std_dev}},
+    ]
+    links = [{"id": 1000, "from": 0, "to": 1, "fromIndex": 0, "toIndex": 0}]
+    for i in range(length):
+        nodes.append({"id": i + 2, "template": "Invert"})
+        links.append({
+            "id": 1001 + i, "from": i + 1, "to": i + 2,
+            "fromIndex": 0, "toIndex": 0,
+        })
+    output = length + 2
+    nodes.append({"id": output, "template": "ImgOut"})
+    links.append({
+        "id": 2000, "from": output - 1, "to": output,
+        "fromIndex": 0, "toIndex": 0,
+    })
+    return {"nodes": nodes, "links": links, "output": output}
+
+
+def test_graph_pool_does_not_leak():
+    """
+    Tests that memory stays flat while pooled graphs are reused, and closed
+    when more shapes come along than the pool keeps.
+    """
+
+    shapes = processor.MAX_POOLED_SHAPES + 8
+
+    def render(i):
+        pipeline = chain_pipeline(i % shapes, 1.0 + i % 3)
+        processor.process(pipeline, LocalImages(), None, viewport=(0, 0, 8, 8))
+
+    for i in range(RENDERS // 10):
+        render(i)
+    before = resident_set_size()
+
+    for i in range(RENDERS):
+        render(i)
+    after = resident_set_size()
+
+    assert after - before < MAX_GROWTH
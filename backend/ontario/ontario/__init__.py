@@ -3,30 +3,693 @@
 
 # autopep8 off
 import gi
-from typing import List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import os
+import struct
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
 gi.require_version('Gegl', '0.4')
+gi.require_version('GdkPixbuf', '2.0')
 from gi.repository import Gegl  # noqa
+from gi.repository import GdkPixbuf, GLib  # noqa
+
+# NumPy is optional, and only needed for to_numpy() and load_from_numpy().
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A region of an image, as (x, y, width, height).
+Rect = Tuple[int, int, int, int]
+
+# Receives the fraction of a render that is done, from 0 to 1.
+ProgressCallback = Callable[[float], None]
 # autopep8 on
 
 
 Gegl.init([])
 
 
+def configure(
+        threads: Optional[int] = None,
+        cache_size: Optional[int] = None,
+        tile_size: Optional[int] = None,
+        swap: Optional[str] = None,
+        chunk_size: Optional[int] = None):
+    """
+    Tunes GEGL for this process. Settings left as None are not changed.
+
+    threads is the number of threads GEGL renders with, cache_size the
+    bytes of tiles it keeps in memory before swapping, tile_size the width
+    and height of new tiles in pixels, swap the directory it swaps tiles to,
+    and chunk_size the pixels a processor renders per step. Tile size and
+    swap directory only apply to buffers created afterwards, so set them
+    before building any images.
+
+    Each server worker has its own GEGL, so give every worker a share of
+    the cores and memory rather than all of them.
+    """
+
+    config = Gegl.config()
+    if threads is not None:
+        config.set_property("threads", threads)
+    if cache_size is not None:
+        config.set_property("tile-cache-size", cache_size)
+    if tile_size is not None:
+        config.set_property("tile-width", tile_size)
+        config.set_property("tile-height", tile_size)
+    if swap is not None:
+        config.set_property("swap", swap)
+    if chunk_size is not None:
+        config.set_property("chunk-size", chunk_size)
+
+
+def _configure_from_environment():
+    """
+    Applies the ONTARIO_GEGL_* environment variables, if any are set.
+    """
+
+    def integer(name: str) -> Optional[int]:
+        value = os.environ.get(name)
+        return int(value) if value else None
+
+    configure(
+        threads=integer("ONTARIO_GEGL_THREADS"),
+        cache_size=integer("ONTARIO_GEGL_CACHE_SIZE"),
+        tile_size=integer("ONTARIO_GEGL_TILE_SIZE"),
+        swap=os.environ.get("ONTARIO_GEGL_SWAP") or None,
+        chunk_size=integer("ONTARIO_GEGL_CHUNK_SIZE"),
+    )
+
+
+_configure_from_environment()
+
+
+# Babl component types and the NumPy types that hold them.
+_NUMPY_TYPES = {
+    "u8": "uint8",
+    "u16": "uint16",
+    "u32": "uint32",
+    "half": "float16",
+    "float": "float32",
+    "double": "float64",
+}
+
+# Channel counts of babl component models, ignoring the ' of nonlinear ones.
+_CHANNELS = {"Y": 1, "YA": 2, "RGB": 3, "RGBA": 4}
+
+# The nonlinear versions of those models, which 8-bit images are stored in.
+_NONLINEAR_MODELS = {
+    "Y": "Y'",
+    "YA": "Y'A",
+    "RGB": "R'G'B'",
+    "RGBA": "R'G'B'A",
+}
+
+
+def _numpy_layout(format: str) -> Tuple[str, int]:
+    """
+    Returns the NumPy type and channel count of a babl format name.
+    """
+
+    model, _, kind = format.rpartition(" ")
+    model = model.replace("'", "")
+    if model not in _CHANNELS or kind not in _NUMPY_TYPES:
+        raise ValueError(f"Unsupported pixel format: {format}")
+    return _NUMPY_TYPES[kind], _CHANNELS[model]
+
+
+def _parse_curve(curve: str) -> Tuple[List[float], List[float]]:
+    """
+    Parses a curve of space separated "x,y" points between 0 and 1.
+    """
+
+    points = []
+    for point in curve.split():
+        x, y = (float(v) for v in point.split(","))
+        if not (0 <= x <= 1 and 0 <= y <= 1):
+            raise ValueError(f"Curve point out of range: {point}")
+        points.append((x, y))
+    if len(points) < 2:
+        raise ValueError("A curve needs at least two points")
+
+    points.sort()
+    return [x for x, _ in points], [y for _, y in points]
+
+
+def _homography(
+        source: List[Tuple[float, float]],
+        target: List[Tuple[float, float]]) -> List[List[float]]:
+    """
+    Solves for the 3x3 projective matrix mapping four points onto four
+    others.
+    """
+
+    # Two equations per point for the eight unknowns; the last is fixed at 1.
+    rows = []
+    for (x, y), (u, v) in zip(source, target):
+        rows.append([x, y, 1, 0, 0, 0, -u * x, -u * y, u])
+        rows.append([0, 0, 0, x, y, 1, -v * x, -v * y, v])
+
+    # Gaussian elimination with partial pivoting.
+    for col in range(8):
+        pivot = max(range(col, 8), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError("Perspective corners must not be collinear")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(8):
+            if r != col:
+                factor = rows[r][col] / rows[col][col]
+                rows[r] = [a - factor * b for a, b in zip(rows[r], rows[col])]
+
+    h = [rows[i][8] / rows[i][i] for i in range(8)] + [1.0]
+    return [h[0:3], h[3:6], h[6:9]]
+
+
+def _matrix_string(matrix: List[List[float]]) -> str:
+    """
+    Formats a 3x3 matrix for gegl:transform, which reads it column by
+    column.
+    """
+
+    values = [matrix[row][col] for col in range(3) for row in range(3)]
+    return "matrix(" + ",".join(repr(v) for v in values) + ")"
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("NumPy is needed for converting images to arrays")
+
+
+def _array_to_buffer(
+        array: Any,
+        format: str,
+        x: int = 0,
+        y: int = 0) -> Gegl.Buffer:
+    """
+    Copies a (height, width, channels) array into a new buffer at (x, y).
+    """
+
+    dtype, channels = _numpy_layout(format)
+    height, width = array.shape[:2]
+    if array.ndim != 3 or array.shape[2] != channels:
+        raise ValueError(
+            f"{format} has {channels} channels, the array has shape "
+            f"{array.shape}")
+
+    buffer = Gegl.Buffer.new(format, x, y, width, height)
+    buffer.set(
+        Gegl.Rectangle.new(x, y, width, height),
+        format,
+        numpy.ascontiguousarray(array, dtype=dtype).tobytes())
+    return buffer
+
+
+# GEGL's webp encoder only writes files, so without a GdkPixbuf webp saver,
+# webp images go through a scratch file here. It is only used on a shared
+# memory filesystem, never on disk.
+_SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Scratch files are named after the process writing them, so files left by
+# processes that died mid-encode can be told apart and removed.
+_SCRATCH_PREFIX = "ontario-encode-"
+
+# Whether scratch files of dead processes were looked for yet.
+_scratch_swept = False
+
+
+def _pixbuf_formats() -> List[str]:
+    return [
+        format.get_name() for format in GdkPixbuf.Pixbuf.get_formats()
+        if format.is_writable()
+    ]
+
+
+def _gegl_webp() -> bool:
+    return _SCRATCH_DIR is not None and Gegl.has_operation("gegl:webp-save")
+
+
+def _sweep_scratch() -> None:
+    """
+    Removes the scratch files of processes that are gone.
+    """
+
+    global _scratch_swept
+    if _scratch_swept:
+        return
+    _scratch_swept = True
+
+    for name in os.listdir(_SCRATCH_DIR):
+        if not name.startswith(_SCRATCH_PREFIX):
+            continue
+        pid = name[len(_SCRATCH_PREFIX):].split("-")[0]
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except (PermissionError, ValueError):
+            continue
+        try:
+            os.remove(os.path.join(_SCRATCH_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def encodable_formats() -> List[str]:
+    """
+    Returns the image formats save_to_bytes() can encode to.
+
+    These are the writable GdkPixbuf formats, and webp if GEGL can encode it
+    instead, so they depend on what is installed on this machine.
+    """
+
+    formats = _pixbuf_formats()
+    if "webp" not in formats and _gegl_webp():
+        formats.append("webp")
+    return formats
+
+
+# Decoders for image files, and the format each one is kept in once decoded.
+_LOADERS = {
+    ".png": ("gegl:png-load", "RGBA float"),
+    ".jpg": ("gegl:jpg-load", "R'G'B'A u8"),
+    ".jpeg": ("gegl:jpg-load", "R'G'B'A u8"),
+    ".exr": ("gegl:exr-load", "RGBA float"),
+    ".webp": ("gegl:webp-load", "R'G'B'A u8"),
+    ".tif": ("gegl:tiff-load", "RGBA float"),
+    ".tiff": ("gegl:tiff-load", "RGBA float"),
+    ".svg": ("gegl:svg-load", "R'G'B'A u8"),
+}
+
+# The loader for files of any other type, which picks one by extension.
+_FALLBACK_LOADER = ("gegl:load", "RGBA float")
+
+# Bytes per pixel of the formats above.
+_PIXEL_SIZES = {"RGBA float": 16, "R'G'B'A u8": 4}
+
+# Leading bytes of the binary image types, and their extensions.
+_MAGIC = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"v/1\x01", ".exr"),
+    (b"II*\x00", ".tiff"),
+    (b"MM\x00*", ".tiff"),
+]
+
+
+def _sniff(path: str) -> Optional[str]:
+    """
+    Guesses the extension for an image file from its first bytes.
+    """
+
+    with open(path, "rb") as f:
+        head = f.read(4096)
+
+    for magic, extension in _MAGIC:
+        if head.startswith(magic):
+            return extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    if head.lstrip().startswith((b"<?xml", b"<svg")) and b"<svg" in head:
+        return ".svg"
+    return None
+
+
+def _jpeg_size(f) -> Optional[Tuple[int, int]]:
+    """
+    Reads the size from the frame header of a jpeg file, skipping the
+    segments before it.
+    """
+
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack(">H", length)[0]
+        # Start of frame markers, apart from the DHT, JPG and DAC ones
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">HH", frame[1:])
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def image_size(path: str) -> Optional[Tuple[int, int]]:
+    """
+    Returns the (width, height) of an image file, or None if it can't be
+    told.
+
+    Only the header is read: png, jpeg and webp headers directly, and other
+    types through GdkPixbuf. No GEGL nodes are built.
+    """
+
+    with open(path, "rb") as f:
+        head = f.read(30)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+            return struct.unpack(">II", head[16:24])
+        if head.startswith(b"\xff\xd8\xff"):
+            return _jpeg_size(f)
+
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", head[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = struct.unpack("<I", head[21:25])[0]
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return (
+                int.from_bytes(head[24:27], "little") + 1,
+                int.from_bytes(head[27:30], "little") + 1,
+            )
+
+    format, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+    if format is None:
+        return None
+    return width, height
+
+
+def _loader_for(path: str) -> Tuple[str, str]:
+    """
+    Returns the load operation for an image file and its decoded format.
+
+    The file's contents decide, since extensions can be missing or wrong.
+    """
+
+    extension = _sniff(path) or os.path.splitext(path)[1].lower()
+    return _LOADERS.get(extension, _FALLBACK_LOADER)
+
+
+def _decode(
+        operation: str,
+        path: str,
+        format: str,
+        max_size: int) -> Optional[Tuple[Gegl.Buffer, int]]:
+    """
+    Decodes an image file into a new buffer, in a graph of its own.
+
+    Returns the buffer and its size in bytes, or None if it would take more
+    than max_size bytes.
+    """
+
+    graph = Gegl.Node()
+    load = graph.create_child(operation)
+    load.set_property("path", path)
+
+    rect = load.get_bounding_box()
+    size = rect.width * rect.height * _PIXEL_SIZES[format]
+    if size > max_size:
+        return None
+
+    buffer = Gegl.Buffer.new(
+        format, rect.x, rect.y, rect.width, rect.height)
+    sink = graph.create_child("gegl:write-buffer")
+    sink.set_property("buffer", buffer)
+    load.link(sink)
+
+    # Decode a chunk of tiles at a time, rather than all in one go.
+    processor = sink.new_processor(rect)
+    while processor.work()[0]:
+        pass
+    return buffer, size
+
+
+class SourceCache:
+    """
+    Keeps decoded image files in memory, evicting the least recently used.
+
+    Files are keyed by path, modification time and size, so a file that is
+    replaced is decoded again. The cached buffers are shared by every graph
+    that loads the file, and must not be written to.
+    """
+
+    # The maximum total size of the decoded images, in bytes.
+    __max_size: int
+
+    # The current total size of the decoded images, in bytes.
+    __current_size: int
+
+    # Map between file keys and (buffer, size), least recently used first.
+    __entries: "OrderedDict[Tuple[str, int, int], Tuple[Gegl.Buffer, int]]"
+
+    # Guards the entries, since images can be loaded on several threads.
+    __lock: threading.Lock
+
+    def __init__(self, max_size: int):
+        self.__max_size = max_size
+        self.__current_size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __key(path: str) -> Tuple[str, int, int]:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def __evict(self):
+        while self.__current_size > self.__max_size and self.__entries:
+            _, (_, size) = self.__entries.popitem(last=False)
+            self.__current_size -= size
+
+    def get(self, path: str) -> Optional[Gegl.Buffer]:
+        """
+        Returns the decoded image for a file, if it is cached.
+        """
+
+        key = self.__key(path)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, path: str, buffer: Gegl.Buffer, size: int):
+        """
+        Caches the decoded image for a file, taking up size bytes.
+        """
+
+        if size > self.__max_size:
+            return
+
+        key = self.__key(path)
+        with self.__lock:
+            if key in self.__entries:
+                self.__current_size -= self.__entries.pop(key)[1]
+            self.__entries[key] = (buffer, size)
+            self.__current_size += size
+            self.__evict()
+
+    def max_size(self) -> int:
+        return self.__max_size
+
+    def set_max_size(self, max_size: int):
+        """
+        Changes the byte budget, evicting images if needed. A budget of 0
+        turns the cache off.
+        """
+
+        with self.__lock:
+            self.__max_size = max_size
+            self.__evict()
+
+    def size(self) -> int:
+        """
+        Returns the current total size of the decoded images, in bytes.
+        """
+
+        with self.__lock:
+            return self.__current_size
+
+    def __contains__(self, path: str) -> bool:
+        key = self.__key(path)
+        with self.__lock:
+            return key in self.__entries
+
+
+# The decoded images shared by every builder in this process.
+source_cache = SourceCache(256 * 1024 * 1024)
+
+
+class RenderCancelled(Exception):
+    """
+    Raised when a render is stopped through its cancellation token.
+    """
+
+
+class CancellationToken:
+    """
+    Stops a render from another thread.
+
+    Renders check the token between chunks of work, so a cancelled render
+    stops within one chunk instead of running to the end.
+    """
+
+    # Set once the render should stop.
+    _cancelled: threading.Event
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+
 class ImageContext:
     """
     The overarching context for an image builder.
+
+    Use it as a context manager, or call close(), to free its GEGL nodes
+    and buffers as soon as the images are done with.
     """
 
     # The underlying parent node
     _parent: Gegl.Node
 
-    def __init__(self):
+    # Whether builders fold runs of per-pixel operations together.
+    _fuse: bool
+
+    # The scale sources are rendered at, below 1 for quick previews.
+    _preview_scale: float
+
+    # The nodes builders created, in the order they were created.
+    _children: List[Gegl.Node]
+
+    # The node feeding each (node, input pad), as linked by builders.
+    _inputs: Dict[Tuple[Gegl.Node, str], Gegl.Node]
+
+    # The next node of _children to hand out when replaying.
+    _next: int
+
+    # The builders made in this context, so they can be emptied with it.
+    _builders: "weakref.WeakSet[ImageBuilder]"
+
+    def __init__(self, fuse: bool = True, preview_scale: float = 1.0):
+        if preview_scale <= 0:
+            raise ValueError("Preview scale must be positive")
+
         self._parent = Gegl.Node()
+        self._fuse = fuse
+        self._preview_scale = preview_scale
+        self._children = []
+        self._inputs = {}
+        self._next = 0
+        self._builders = weakref.WeakSet()
+
+    def __enter__(self) -> "ImageContext":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def reset_context(self):
+        """
+        Removes every node from the context, and empties the builders made
+        in it, so that neither keeps the old nodes or their buffers alive.
+        The builders can be used again afterwards.
+        """
+
+        for builder in list(self._builders):
+            builder._clear()
         for child in self._parent.get_children():
             self._parent.remove_child(child)
+        self._children = []
+        self._inputs = {}
+        self._next = 0
+
+    def close(self):
+        """
+        Frees every node and buffer in the context and forgets its builders.
+        """
+
+        self.reset_context()
+        self._builders = weakref.WeakSet()
+
+    def rewind(self):
+        """
+        Starts building the same graph again.
+
+        Builders made afterwards get this context's existing nodes back in
+        the order they were first created, as long as the operations match,
+        and only properties and links that changed are set. GEGL keeps the
+        cached results of every node that was left untouched. Once the graph
+        deviates from the old one, the remaining old nodes are dropped and
+        new ones are created.
+        """
+
+        self._next = 0
+
+    def trim(self):
+        """
+        Drops the nodes that were not reused since the last rewind().
+        """
+
+        self.__drop(self._next)
+
+    def __drop(self, start: int):
+        dropped = self._children[start:]
+        if not dropped:
+            return
+
+        del self._children[start:]
+        for key, producer in list(self._inputs.items()):
+            node, pad = key
+            if node in dropped:
+                node.disconnect(pad)
+                del self._inputs[key]
+        for child in dropped:
+            self._parent.remove_child(child)
+
+    def _create_child(self, operation: str) -> Gegl.Node:
+        """
+        Creates a child node, or reuses the next one when replaying.
+        """
+
+        if self._next < len(self._children):
+            node = self._children[self._next]
+            if node.get_operation() == operation:
+                self._next += 1
+                return node
+
+            # The graph changed shape here; nothing after it can be reused.
+            self.__drop(self._next)
+
+        node = self._parent.create_child(operation)
+        self._children.append(node)
+        self._next += 1
+        return node
+
+    def _set_property(self, node: Gegl.Node, name: str, value: Any):
+        """
+        Sets a node property, unless it already has that value.
+        """
+
+        if node.get_property(name) != value:
+            node.set_property(name, value)
+
+    def _link(self, producer: Gegl.Node, node: Gegl.Node, pad: str):
+        """
+        Connects a node's output to an input pad, unless it already is.
+        """
+
+        if self._inputs.get((node, pad)) is not producer:
+            producer.connect_to("output", node, pad)
+            self._inputs[(node, pad)] = producer
 
 
 class ImageBuilder:
@@ -40,62 +703,235 @@ class ImageBuilder:
     # The parent node.
     __parent: Gegl.Node
 
+    # The context the nodes are created in.
+    __context: ImageContext
+
+    # Whether point operations are fused as they are added.
+    __fuse: bool
+
+    # The preview scale of the context. Sources are downscaled by it, and
+    # sizes given in full resolution pixels are multiplied by it.
+    __scale: float
+
     def __init__(self, context: ImageContext):
         self.__nodes = []
         self.__parent = context._parent
+        self.__context = context
+        self.__fuse = context._fuse
+        self.__scale = context._preview_scale
+        context._builders.add(self)
 
-    def load_from_file(self, path: str) -> "ImageBuilder":
+    def fork(self) -> "ImageBuilder":
         """
-        Loads an image file to create a source node.
-        Currently only supports .png, .jpg, and .exr
+        Creates a new builder that continues from this builder's last node.
+
+        The two builders share their GEGL nodes so far, but operations added
+        to one of them afterwards do not affect the other.
         """
 
-        # get file extention
-        split_ext: tuple = os.path.splitext(path)
-        file_ext: str = split_ext[-1]
-        file_ext = file_ext.lower()
+        other = ImageBuilder.__new__(ImageBuilder)
+        other.__nodes = list(self.__nodes)
+        other.__parent = self.__parent
+        other.__context = self.__context
+        other.__fuse = self.__fuse
+        other.__scale = self.__scale
+        self.__context._builders.add(other)
+        return other
 
-        # add node as a child to the image context
-        if file_ext == '.png':
-            node = self.__parent.create_child("gegl:png-load")
-            node.set_property("path", path)
+    def _clear(self):
+        """
+        Forgets every node, for when the context is reset.
+        """
 
-        elif file_ext == '.jpg' or file_ext == '.jpeg':
-            node = self.__parent.create_child("gegl:jpg-load")
-            node.set_property("path", path)
+        self.__nodes = []
 
-        elif file_ext == '.exr':
-            node = self.__parent.create_child("gegl:exr-load")
-            node.set_property("path", path)
+    def is_empty(self) -> bool:
+        """
+        Returns whether the builder has no image yet, or lost it when its
+        context was reset or closed.
+        """
 
-        elif file_ext == '.webp':
-            node = self.__parent.create_child("gegl:webp-load")
-            node.set_property("path", path)
+        return not self.__nodes
 
-        elif file_ext == '.svg':
-            # TODO
-            pass
+    def __create(self, operation: str) -> Gegl.Node:
+        return self.__context._create_child(operation)
 
-        else:
-            print(f"Error: Wrong file format: {file_ext}")
+    def __set(self, node: Gegl.Node, name: str, value: Any):
+        self.__context._set_property(node, name, value)
+
+    def __link(
+            self,
+            producer: Gegl.Node,
+            node: Gegl.Node,
+            pad: str = "input"):
+        self.__context._link(producer, node, pad)
+
+    def __scaled(self, size: float) -> float:
+        """
+        Converts a full resolution size to the preview resolution.
+        """
+
+        return size * self.__scale
+
+    def __scaled_int(self, size: int) -> int:
+        """
+        Converts a full resolution size in whole pixels, keeping it at least
+        one pixel either way from zero.
+        """
+
+        if self.__scale == 1.0 or size == 0:
+            return size
+        scaled = max(1, round(abs(size) * self.__scale))
+        return scaled if size > 0 else -scaled
+
+    def __downscale_source(self):
+        """
+        Downscales the source node that was just added when previewing.
+        """
+
+        if self.__scale == 1.0:
+            return
+
+        node = self.__create("gegl:scale-ratio")
+        self.__set(node, "x", self.__scale)
+        self.__set(node, "y", self.__scale)
+
+        self.__link(self.__nodes[-1], node)
+        self.__nodes.append(node)
+
+    def __tail_is(self, operation: str) -> bool:
+        """
+        Whether the last node is an operation that this builder appended
+        itself, and that can therefore be folded into the next one.
+        """
+
+        return self.__fuse and len(self.__nodes) >= 2 and \
+            self.__nodes[-1].get_operation() == operation
+
+    def __tail_affine(self) -> Optional[Tuple[float, float]]:
+        """
+        Returns the (brightness, contrast) of the last node if it is an
+        affine map of each channel that can be folded into the next one.
+
+        Brightness-contrast maps x to (x - 0.5) * contrast + brightness + 0.5,
+        and inverting maps x to 1 - x, which is the same with a contrast of
+        -1 and no brightness.
+        """
+
+        if self.__tail_is("gegl:brightness-contrast"):
+            tail = self.__nodes[-1]
+            return tail.get_property("brightness"), \
+                tail.get_property("contrast")
+        if self.__tail_is("gegl:invert-linear"):
+            return 0.0, -1.0
+        return None
+
+    def __replace_tail(self, brightness: float, contrast: float):
+        """
+        Replaces the last node with a brightness-contrast node.
+
+        The previous node is left unlinked rather than modified, since a
+        forked builder may still be using it.
+        """
+
+        node = self.__create("gegl:brightness-contrast")
+        self.__set(node, "contrast", contrast)
+        self.__set(node, "brightness", brightness)
+
+        self.__link(self.__nodes[-2], node)
+        self.__nodes[-1] = node
+
+    def load_from_file(self, path: str, cache: bool = True) \
+            -> "ImageBuilder":
+        """
+        Loads an image file to create a source node.
+
+        The type is detected from the first bytes of the file, then from its
+        extension. png, jpeg, webp, exr, tiff and svg files are supported,
+        and anything else is left to gegl:load.
+
+        Decoded files are kept in source_cache, so loading the same file
+        again skips decoding it. Files bigger than the cache, and files
+        loaded with cache set to False, get a load node instead, which GEGL
+        decodes as the tiles are needed.
+        """
+
+        operation, format = _loader_for(path)
+
+        # Reuse an earlier decode of the same file, or keep this one
+        if cache and source_cache.max_size() > 0:
+            buffer = source_cache.get(path)
+            if buffer is not None:
+                return self.load_from_buffer(buffer)
+
+            decoded = _decode(
+                operation, path, format, source_cache.max_size())
+            if decoded is not None:
+                buffer, size = decoded
+                source_cache.put(path, buffer, size)
+                return self.load_from_buffer(buffer)
+
+        node = self.__create(operation)
+        self.__set(node, "path", path)
 
         # add node to node list
         self.__nodes.append(node)
+        self.__downscale_source()
         return self
 
-    def load_from_buffer(self, buffer: Gegl.Buffer) -> "ImageBuilder":
+    def load_from_buffer(
+            self,
+            buffer: Gegl.Buffer,
+            prescaled: bool = False) -> "ImageBuilder":
         """
         Loads a buffer to create a source node.
+
+        Buffers that were rendered by a context with the same preview scale
+        should pass prescaled, so they are not downscaled twice.
         """
 
         # create new source buffer node
-        node = self.__parent.create_child("gegl:buffer-source")
-        node.set_property("buffer", buffer)
+        node = self.__create("gegl:buffer-source")
+        self.__set(node, "buffer", buffer)
 
         # add node to node list
         self.__nodes.append(node)
+        if not prescaled:
+            self.__downscale_source()
         return self
 
+    def load_from_numpy(
+            self,
+            array: Any,
+            format: Optional[str] = None) -> "ImageBuilder":
+        """
+        Loads an array of shape (height, width) or (height, width, channels)
+        to create a source node.
+
+        Without a format, 8-bit arrays are taken to be sRGB and every other
+        type linear, with 1 to 4 channels being Y, YA, RGB or RGBA.
+        """
+
+        _require_numpy()
+        if array.ndim == 2:
+            array = array[:, :, numpy.newaxis]
+        channels = array.shape[2]
+
+        if format is None:
+            models = {value: key for key, value in _CHANNELS.items()}
+            kinds = {value: key for key, value in _NUMPY_TYPES.items()}
+            if channels not in models or array.dtype.name not in kinds:
+                raise ValueError(
+                    f"No pixel format for {channels} channels of "
+                    f"{array.dtype.name}")
+            model = models[channels]
+            kind = kinds[array.dtype.name]
+            if kind == "u8":
+                model = _NONLINEAR_MODELS[model]
+            format = f"{model} {kind}"
+
+        return self.load_from_buffer(_array_to_buffer(array, format))
+
     def save_to_file(self, path: str) -> "ImageBuilder":
         """
         Saves an image of arbitrary type to a file.
@@ -103,24 +939,35 @@ class ImageBuilder:
 
         # create generic image save node (uses different save handlers,
         # depending on file type)
-        node = self.__parent.create_child("gegl:save")
-        node.set_property("path", path)
+        node = self.__create("gegl:save")
+        self.__set(node, "path", path)
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
 
-    def save_to_buffer(self, shadow) -> Gegl.Buffer:
+    def save_to_buffer(self, shadow, rect: Optional[Rect] = None) \
+            -> Gegl.Buffer:
         """
         Saves an image to a buffer.
+
+        If a rect is given, only that region is computed and written. Like
+        the rects of process(), it is in rendered pixels.
         """
 
-        node = self.__parent.create_child("gegl:write-buffer")
-        node.set_property("buffer", shadow)
+        if rect is not None:
+            node = self.__create("gegl:crop")
+            for name, value in zip(("x", "y", "width", "height"), rect):
+                self.__set(node, name, value)
+            self.__link(self.__nodes[-1], node)
+            self.__nodes.append(node)
+
+        node = self.__create("gegl:write-buffer")
+        self.__set(node, "buffer", shadow)
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return shadow
@@ -130,10 +977,10 @@ class ImageBuilder:
         Saves a gegl buffer to a GdkPixbuf.
         """
 
-        node = self.__parent.create_child("gegl:save-pixbuf")
-        node.set_property("pixbuf", pixbuf)
+        node = self.__create("gegl:save-pixbuf")
+        self.__set(node, "pixbuf", pixbuf)
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return pixbuf
@@ -146,11 +993,11 @@ class ImageBuilder:
         Composites two images.
         """
 
-        node = self.__parent.create_child("gegl:over")
+        node = self.__create("gegl:over")
 
         # Connect the last node to the save node.
-        self.__nodes[-1].connect_to("output", node, "input")
-        other.__nodes[-1].connect_to("output", node, "aux")
+        self.__link(self.__nodes[-1], node)
+        self.__link(other.__nodes[-1], node, "aux")
 
         self.__nodes.append(node)
         return self
@@ -160,11 +1007,22 @@ class ImageBuilder:
         Inverts an image.
         """
 
+        # Inverting twice is the identity, so drop the previous invert
+        # rather than making two passes over every pixel, and an invert
+        # after brightness-contrast negates both of its values.
+        if self.__tail_is("gegl:invert-linear"):
+            self.__nodes.pop()
+            return self
+        if self.__tail_is("gegl:brightness-contrast"):
+            brightness, contrast = self.__tail_affine()
+            self.__replace_tail(-brightness, -contrast)
+            return self
+
         # create child node invert
-        node = self.__parent.create_child("gegl:invert-linear")
+        node = self.__create("gegl:invert-linear")
 
         # Connect the last node to the new node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         # add new node to node list
         self.__nodes.append(node)
@@ -176,12 +1034,12 @@ class ImageBuilder:
         """
 
         # create child node translate
-        node = self.__parent.create_child("gegl:translate")
-        node.set_property("x", x)
-        node.set_property("y", y)
+        node = self.__create("gegl:translate")
+        self.__set(node, "x", self.__scaled(x))
+        self.__set(node, "y", self.__scaled(y))
 
         # Connect the last node to the new node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         # add new node to node list
         self.__nodes.append(node)
@@ -192,14 +1050,14 @@ class ImageBuilder:
         Crops an image.
         """
 
-        node = self.__parent.create_child("gegl:crop")
-        node.set_property("x", x)
-        node.set_property("y", y)
-        node.set_property("width", width)
-        node.set_property("height", height)
+        node = self.__create("gegl:crop")
+        self.__set(node, "x", self.__scaled(x))
+        self.__set(node, "y", self.__scaled(y))
+        self.__set(node, "width", self.__scaled(width))
+        self.__set(node, "height", self.__scaled(height))
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         # add new node to node list
         self.__nodes.append(node)
@@ -210,24 +1068,44 @@ class ImageBuilder:
         Crops an image.
         """
 
-        node = self.__parent.create_child("gegl:dropshadow")
-        node.set_property("x", x)
-        node.set_property("y", y)
-        node.set_property("radius", radius)
-        node.set_property("grow-radius", size)
+        node = self.__create("gegl:dropshadow")
+        self.__set(node, "x", self.__scaled(x))
+        self.__set(node, "y", self.__scaled(y))
+        self.__set(node, "radius", self.__scaled(radius))
+        self.__set(node, "grow-radius", self.__scaled_int(size))
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
         self.__nodes.append(node)
 
         return self
 
     def flip(self, horizontal: bool, vertical: bool) -> "ImageBuilder":
         """
-        Flips an image.
+        Flips an image in place, within its own bounds.
         """
 
-        # TODO: need to implement transform operations, namely "gegl:reflect"
+        # Mirror about an axis through the origin, then move the image back
+        # into its own bounds.
+        rect = self.__nodes[-1].get_bounding_box()
+        flips = []
+        if horizontal:
+            flips.append((0.0, 1.0, 2.0 * rect.x + rect.width, 0.0))
+        if vertical:
+            flips.append((1.0, 0.0, 0.0, 2.0 * rect.y + rect.height))
+
+        for axis_x, axis_y, shift_x, shift_y in flips:
+            node = self.__create("gegl:reflect")
+            self.__set(node, "x", axis_x)
+            self.__set(node, "y", axis_y)
+            self.__link(self.__nodes[-1], node)
+            self.__nodes.append(node)
+
+            node = self.__create("gegl:translate")
+            self.__set(node, "x", shift_x)
+            self.__set(node, "y", shift_y)
+            self.__link(self.__nodes[-1], node)
+            self.__nodes.append(node)
 
         return self
 
@@ -240,13 +1118,13 @@ class ImageBuilder:
         Rotates an image.
         """
 
-        node = self.__parent.create_child("gegl:rotate")
-        node.set_property("origin-x", origin_x)
-        node.set_property("origin-y", origin_x)
-        node.set_property("degrees", degrees)
+        node = self.__create("gegl:rotate")
+        self.__set(node, "origin-x", self.__scaled(origin_x))
+        self.__set(node, "origin-y", self.__scaled(origin_x))
+        self.__set(node, "degrees", degrees)
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -256,12 +1134,12 @@ class ImageBuilder:
         Resizes an image.
         """
 
-        node = self.__parent.create_child("gegl:scale-size")
-        node.set_property("x", width)
-        node.set_property("y", height)
+        node = self.__create("gegl:scale-size")
+        self.__set(node, "x", self.__scaled(width))
+        self.__set(node, "y", self.__scaled(height))
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -273,13 +1151,33 @@ class ImageBuilder:
             yellow_blue: float) -> "ImageBuilder":
         """
         Color balances an image.
+
+        Each value, from -1 to 1, shifts the image towards the second color
+        of its pair by scaling that channel in linear light.
         """
 
-        # TODO: need to implement a few different operation
-        # namely "gegl:component-extract"
-        # to separate channels and then compositing to combine. May need to be
-        # done in the gtk node side
+        if cyan_red == magenta_green == yellow_blue == 0:
+            return self
+
+        gains = self.__create("gegl:color")
+        color = Gegl.Color.new("black")
+        color.set_rgba(1 + cyan_red, 1 + magenta_green, 1 + yellow_blue, 1)
+        self.__set(gains, "value", color)
+
+        node = self.__create("gegl:multiply")
+        self.__link(self.__nodes[-1], node)
+        self.__link(gains, node, "aux")
+
+        # The gain color covers the whole plane, so crop back to the input.
+        rect = self.__nodes[-1].get_bounding_box()
+        crop = self.__create("gegl:crop")
+        self.__set(crop, "x", rect.x)
+        self.__set(crop, "y", rect.y)
+        self.__set(crop, "width", rect.width)
+        self.__set(crop, "height", rect.height)
+        self.__link(node, crop)
 
+        self.__nodes.append(crop)
         return self
 
     def brightness_contrast(
@@ -293,12 +1191,24 @@ class ImageBuilder:
         Note: -3 <= Brightness <= 3
         """
 
-        node = self.__parent.create_child("gegl:brightness-contrast")
-        node.set_property("contrast", contrast)
-        node.set_property("brightness", brightness)
+        # Brightness-contrast is an affine map of each channel, so it
+        # composes with a previous one or an invert, as long as the result
+        # is still in range.
+        tail = self.__tail_affine()
+        if tail is not None:
+            fused_contrast = tail[1] * contrast
+            fused_brightness = tail[0] * contrast + brightness
+
+            if abs(fused_contrast) <= 5 and abs(fused_brightness) <= 3:
+                self.__replace_tail(fused_brightness, fused_contrast)
+                return self
+
+        node = self.__create("gegl:brightness-contrast")
+        self.__set(node, "contrast", contrast)
+        self.__set(node, "brightness", brightness)
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -312,13 +1222,13 @@ class ImageBuilder:
         Hue, chroma, and lightness an image.
         """
 
-        node = self.__parent.create_child("gegl:hue-chroma")
-        node.set_property("hue", hue)
-        node.set_property("chroma", chroma)
-        node.set_property("lightness", lightness)
+        node = self.__create("gegl:hue-chroma")
+        self.__set(node, "hue", hue)
+        self.__set(node, "chroma", chroma)
+        self.__set(node, "lightness", lightness)
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -326,10 +1236,73 @@ class ImageBuilder:
     def curves(self, curve: str) -> "ImageBuilder":
         """
         Curves an image.
+
+        The curve is a list of "x,y" points between 0 and 1, like
+        "0,0 0.25,0.15 0.75,0.85 1,1", which is interpolated linearly and
+        applied to each RGB channel in gamma 2.2 space, which is close to
+        the sRGB values the points usually come from. Alpha is unchanged.
+
+        GEGL has no color curves operation, so the curve is built from point
+        operations as a sum of ramps, one per segment: each clips the image
+        to its segment and scales it by its slope. Like any other operation,
+        it is only rendered when and where the image is.
         """
 
-        # TODO: once again will have to use something like
-        # "gegl:contrast-curve" and component extraction
+        xs, ys = _parse_curve(curve)
+
+        # The points are on nonlinear values, which pow() can't take below 0.
+        clip = self.__create("gegl:rgb-clip")
+        self.__set(clip, "clip-low", True)
+        self.__set(clip, "low-limit", 0.0)
+        self.__set(clip, "clip-high", True)
+        self.__set(clip, "high-limit", 1.0)
+        self.__link(self.__nodes[-1], clip)
+        encode = self.__create("gegl:gamma")
+        self.__set(encode, "value", 1 / 2.2)
+        self.__link(clip, encode)
+
+        # f(v) = y0 + sum of slope * (clamp(v, x0, x1) - x0) over segments;
+        # the x0 terms are folded into a single offset at the end.
+        total = None
+        offset = ys[0]
+        for x0, x1, y0, y1 in zip(xs, xs[1:], ys, ys[1:]):
+            if x1 <= x0 or y1 == y0:
+                continue
+            slope = (y1 - y0) / (x1 - x0)
+            offset -= slope * x0
+
+            ramp = self.__create("gegl:rgb-clip")
+            self.__set(ramp, "clip-low", True)
+            self.__set(ramp, "low-limit", x0)
+            self.__set(ramp, "clip-high", True)
+            self.__set(ramp, "high-limit", x1)
+            self.__link(encode, ramp)
+            scale = self.__create("gegl:multiply")
+            self.__set(scale, "value", slope)
+            self.__link(ramp, scale)
+
+            if total is None:
+                total = scale
+            else:
+                add = self.__create("gegl:add")
+                self.__link(total, add)
+                self.__link(scale, add, "aux")
+                total = add
+
+        if total is None:
+            # A flat curve.
+            total = self.__create("gegl:multiply")
+            self.__set(total, "value", 0.0)
+            self.__link(encode, total)
+        shift = self.__create("gegl:add")
+        self.__set(shift, "value", offset)
+        self.__link(total, shift)
+
+        decode = self.__create("gegl:gamma")
+        self.__set(decode, "value", 2.2)
+        self.__link(shift, decode)
+
+        self.__nodes.append(decode)
         return self
 
     def unsharp_mask(self, radius: float, amount: float) -> "ImageBuilder":
@@ -337,12 +1310,12 @@ class ImageBuilder:
         Unsharp masks an image.
         """
 
-        node = self.__parent.create_child("gegl:unsharp-mask")
-        node.set_property("std-dev", radius)
-        node.set_property("scale", amount)
+        node = self.__create("gegl:unsharp-mask")
+        self.__set(node, "std-dev", self.__scaled(radius))
+        self.__set(node, "scale", amount)
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -352,12 +1325,12 @@ class ImageBuilder:
         Gaussian blurs an image.
         """
 
-        node = self.__parent.create_child("gegl:gaussian-blur")
-        node.set_property("std-dev-x", x)
-        node.set_property("std-dev-y", y)
+        node = self.__create("gegl:gaussian-blur")
+        self.__set(node, "std-dev-x", self.__scaled(x))
+        self.__set(node, "std-dev-y", self.__scaled(y))
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -367,13 +1340,13 @@ class ImageBuilder:
         Apply waterpixel effect to image
         """
 
-        node = self.__parent.create_child("gegl:waterpixels")
-        node.set_property("size", size)
-        node.set_property("smoothness", smoothness)
-        node.set_property("regularization", regularization)
+        node = self.__create("gegl:waterpixels")
+        self.__set(node, "size", self.__scaled_int(size))
+        self.__set(node, "smoothness", smoothness)
+        self.__set(node, "regularization", regularization)
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -383,12 +1356,12 @@ class ImageBuilder:
         Apply tile glass effect to image
         """
 
-        node = self.__parent.create_child("gegl:tile-glass")
-        node.set_property("tile-width", width)
-        node.set_property("tile-height", height)
+        node = self.__create("gegl:tile-glass")
+        self.__set(node, "tile-width", self.__scaled_int(width))
+        self.__set(node, "tile-height", self.__scaled_int(height))
 
         # Connect the last node to the save node.
-        self.__nodes[-1].link(node)
+        self.__link(self.__nodes[-1], node)
 
         self.__nodes.append(node)
         return self
@@ -406,15 +1379,20 @@ class ImageBuilder:
         Produce text pixel buffer
         """
 
-        node = self.__parent.create_child("gegl:text")
-        node.set_property("string", string)
-        node.set_property("font", font)
-        node.set_property("size", size)
-        node.set_property("color", Gegl.Color.new(color))
-        node.set_property("wrap_width", wrap_width)
-        node.set_property("wrap_height", wrap_height)
-        node.set_property("alignment", alignment)
-        node.set_property("vert_alignment", vert_alignment)
+        node = self.__create("gegl:text")
+        self.__set(node, "string", string)
+        self.__set(node, "font", font)
+        self.__set(node, "size", self.__scaled(size))
+        self.__set(node, "color", Gegl.Color.new(color))
+        # Wrap sizes of -1 mean no wrapping, so only scale real sizes.
+        if wrap_width > 0:
+            wrap_width = self.__scaled_int(wrap_width)
+        if wrap_height > 0:
+            wrap_height = self.__scaled_int(wrap_height)
+        self.__set(node, "wrap_width", wrap_width)
+        self.__set(node, "wrap_height", wrap_height)
+        self.__set(node, "alignment", alignment)
+        self.__set(node, "vert_alignment", vert_alignment)
 
         self.__nodes.append(node)
         return node.get_property("width"), node.get_property("height")
@@ -431,14 +1409,255 @@ class ImageBuilder:
             y3: float) -> "ImageBuilder":
         """
         Perspective transforms an image.
+
+        The image's top left, top right, bottom right and bottom left
+        corners are moved to (x0, y0) to (x3, y3) respectively.
         """
 
-        # TODO: involves the use of several transform operations.
+        rect = self.__nodes[-1].get_bounding_box()
+        left, top = rect.x, rect.y
+        right, bottom = rect.x + rect.width, rect.y + rect.height
+
+        corners = [(x0, y0), (x1, y1), (x2, y2), (x3, y3)]
+        matrix = _homography(
+            [(left, top), (right, top), (right, bottom), (left, bottom)],
+            [(self.__scaled(x), self.__scaled(y)) for x, y in corners])
+
+        node = self.__create("gegl:transform")
+        self.__set(node, "transform", _matrix_string(matrix))
+
+        # Connect the last node to the new node.
+        self.__link(self.__nodes[-1], node)
+
+        self.__nodes.append(node)
         return self
 
-    def process(self):
+    def extent(self) -> Tuple[int, int, int, int]:
+        """
+        Returns the (x, y, width, height) of the image.
+        """
+
+        rect = self.__nodes[-1].get_bounding_box()
+        return rect.x, rect.y, rect.width, rect.height
+
+    def to_buffer(
+            self,
+            rect: Optional[Rect] = None,
+            progress: Optional[ProgressCallback] = None,
+            cancel: Optional[CancellationToken] = None,
+            format: str = "RGBA float") -> Gegl.Buffer:
+        """
+        Renders the image into a new buffer of the given babl format.
+
+        If a rect is given, only that region is rendered. The builder is left
+        unchanged, so more operations can be added. Progress and
+        cancellation work as they do for process().
+        """
+
+        node = self.__nodes[-1]
+        if rect is None:
+            rect = node.get_bounding_box()
+            if rect.is_infinite_plane():
+                raise ValueError(
+                    "Cannot render an infinite image to a buffer")
+        else:
+            rect = Gegl.Rectangle.new(*rect)
+
+        buffer = Gegl.Buffer.new(
+            format, rect.x, rect.y, rect.width, rect.height)
+        # The sink is transient, so keep it out of the context's replay log.
+        sink = self.__parent.create_child("gegl:write-buffer")
+        sink.set_property("buffer", buffer)
+        node.link(sink)
+        try:
+            self.__work(sink, rect, progress, cancel)
+        finally:
+            # The sink is not part of the chain, so drop it again.
+            sink.disconnect("input")
+            self.__parent.remove_child(sink)
+        return buffer
+
+    def to_numpy(
+            self,
+            format: str = "RGBA float",
+            rect: Optional[Rect] = None) -> Any:
+        """
+        Renders the image into an array of shape (height, width, channels).
+
+        The format is a babl format name made of Y, YA, RGB or RGBA and
+        a component type. The array is read-only, since it shares memory
+        with the rendered pixels; copy() it to modify it.
+        """
+
+        _require_numpy()
+        dtype, channels = _numpy_layout(format)
+
+        buffer = self.to_buffer(rect)
+        extent = buffer.get_extent()
+        pixels = buffer.get(extent, 1.0, format, Gegl.AbyssPolicy.NONE)
+        return numpy.frombuffer(pixels, dtype=dtype).reshape(
+            extent.height, extent.width, channels)
+
+    def save_to_bytes(
+            self,
+            format: str = "png",
+            quality: Optional[int] = None,
+            progress: Optional[ProgressCallback] = None,
+            cancel: Optional[CancellationToken] = None) -> bytes:
+        """
+        Renders the image and encodes it in memory.
+
+        The format is a GdkPixbuf format name such as png or jpeg, see
+        encodable_formats(). The quality, from 0 to 100, is used by lossy
+        formats such as jpeg and webp. Progress and cancellation work as they
+        do for process().
+
+        The image is rendered at 8 bits per channel, 4 bytes per pixel, and
+        encoded in memory. Only webp without a GdkPixbuf saver is encoded by
+        GEGL, through a scratch file in shared memory.
+        """
+
+        if format == "jpg":
+            format = "jpeg"
+        through_gegl = False
+        if format not in _pixbuf_formats():
+            if format != "webp" or not _gegl_webp():
+                raise ValueError(f"Cannot encode images as {format}")
+            through_gegl = True
+
+        # Render straight to 8 bits, which is all the encoders take.
+        buffer = self.to_buffer(
+            progress=progress, cancel=cancel, format="R'G'B'A u8")
+        if through_gegl:
+            return self.__encode_webp(buffer, quality)
+
+        rect = buffer.get_extent()
+        pixels = buffer.get(
+            rect, 1.0, "R'G'B'A u8", Gegl.AbyssPolicy.NONE)
+        del buffer
+
+        # GLib.Bytes copies the pixels, so let go of ours right after.
+        data = GLib.Bytes.new(pixels)
+        del pixels
+        pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(
+            data,
+            GdkPixbuf.Colorspace.RGB,
+            True,
+            8,
+            rect.width,
+            rect.height,
+            rect.width * 4)
+
+        keys = []
+        values = []
+        if quality is not None and format in ("jpeg", "webp"):
+            keys.append("quality")
+            values.append(str(quality))
+
+        _, data = pixbuf.save_to_bufferv(format, keys, values)
+        return bytes(data)
+
+    @staticmethod
+    def __encode_webp(
+            buffer: Gegl.Buffer,
+            quality: Optional[int]) -> bytes:
+        """
+        Encodes a rendered buffer with GEGL's webp encoder.
+
+        The encoder only writes to files, so this goes through a scratch
+        file in shared memory that is read back and removed.
+        """
+
+        _sweep_scratch()
+        fd, p = tempfile.mkstemp(
+            dir=_SCRATCH_DIR, prefix=f"{_SCRATCH_PREFIX}{os.getpid()}-")
+        os.close(fd)
+        try:
+            graph = Gegl.Node()
+            source = graph.create_child("gegl:buffer-source")
+            source.set_property("buffer", buffer)
+            sink = graph.create_child("gegl:webp-save")
+            sink.set_property("path", p)
+            if quality is not None:
+                sink.set_property("quality", max(1, quality))
+            source.link(sink)
+            sink.process()
+
+            with open(p, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(p)
+
+    def prerender(
+            self,
+            rect: Optional[Rect] = None,
+            progress: Optional[ProgressCallback] = None,
+            cancel: Optional[CancellationToken] = None):
+        """
+        Computes the image up to the last node without saving it.
+
+        GEGL keeps the results of cached operations, so a later process()
+        that depends on this image reuses them. If a rect is given, only the
+        tiles needed for that region are computed. Progress and cancellation
+        work as they do for process().
+        """
+
+        node = self.__nodes[-1]
+        if rect is None:
+            self.__work(node, node.get_bounding_box(), progress, cancel)
+        else:
+            self.__work(node, Gegl.Rectangle.new(*rect), progress, cancel)
+
+    def process(
+            self,
+            rect: Optional[Rect] = None,
+            progress: Optional[ProgressCallback] = None,
+            cancel: Optional[CancellationToken] = None):
         """
         Processes the image.
+
+        If a rect is given, GEGL only computes the tiles needed for that
+        region. Rects are in rendered pixels, so they are not affected by
+        the preview scale. Sinks that always consume their whole input, like
+        save_to_file(), should be preceded by crop() instead.
+
+        If a progress callback is given, it is called with the fraction done
+        after every chunk of work. If a cancellation token is given and gets
+        cancelled, the render stops after the current chunk and raises
+        RenderCancelled. The GEGL processor renders the input of sinks that
+        consume it whole, like save_to_file(), chunk by chunk before handing
+        it over, so they can be stopped part way too.
         """
 
-        self.__nodes[-1].process()
+        node = self.__nodes[-1]
+        if rect is not None:
+            self.__work(node, Gegl.Rectangle.new(*rect), progress, cancel)
+        elif progress is not None or cancel is not None:
+            box = node.get_bounding_box()
+            if box.is_empty() and len(self.__nodes) > 1:
+                # Sinks have no output, so take the size of their input.
+                box = self.__nodes[-2].get_bounding_box()
+            self.__work(node, box, progress, cancel)
+        else:
+            node.process()
+
+    @staticmethod
+    def __work(
+            node: Gegl.Node,
+            rect: Gegl.Rectangle,
+            progress: Optional[ProgressCallback] = None,
+            cancel: Optional[CancellationToken] = None):
+        """
+        Runs a GEGL processor over a region of a node, one chunk at a time.
+        """
+
+        processor = node.new_processor(rect)
+        while True:
+            if cancel is not None and cancel.is_cancelled():
+                raise RenderCancelled()
+
+            more, done = processor.work()
+            if progress is not None:
+                progress(done if more else 1.0)
+            if not more:
+                break
@@ -1,8 +1,13 @@
 #  GNU AGPL v3 License
 # Written by John Nunley
 
+import os
 import os.path as path
+import shutil
 import tempfile
+from array import array
+
+import pytest
 
 import ontario
 
@@ -119,3 +124,448 @@ def test_unsharp_mask():
     builder.load_from_file(TEST_IMAGE_PATH)
     builder.unsharp_mask(0.5, 0.5)
     builder.process()
+
+
+def render_adjustments(fuse, chain):
+    """
+    Renders a chain of point operations to a list of floats.
+    """
+
+    context = ontario.ImageContext(fuse=fuse)
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    for step in chain:
+        if step is None:
+            builder.invert()
+        else:
+            builder.brightness_contrast(*step)
+
+    buffer = builder.to_buffer()
+    pixels = array("f")
+    pixels.frombytes(
+        buffer.get(buffer.get_extent(), 1.0, "RGBA float",
+                   ontario.Gegl.AbyssPolicy.NONE))
+    return pixels
+
+
+def test_point_fusion():
+    """
+    Tests that fused point operations match the unfused output.
+    """
+
+    # Brightness-contrast steps are (brightness, contrast), inverts None
+    chains = (
+        [(0.1, 1.5), (-0.2, 0.8), None, None, (0.05, 1.1)],
+        [None, (0.1, 1.5)],
+        [(0.1, 1.5), None],
+        [None, (0.2, 0.5), None, (-0.1, 2.0), None],
+        [(2.5, 1.0), None, (2.0, 4.0)],
+    )
+    for chain in chains:
+        fused = render_adjustments(True, chain)
+        unfused = render_adjustments(False, chain)
+
+        assert len(fused) == len(unfused)
+        assert all(abs(a - b) < 1e-4 for a, b in zip(fused, unfused))
+
+
+def test_region_of_interest():
+    """
+    Tests rendering only part of an image.
+    """
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    builder.invert()
+    builder.prerender((0, 0, 16, 16))
+
+    buffer = builder.to_buffer((8, 8, 16, 16))
+    extent = buffer.get_extent()
+    assert (extent.x, extent.y, extent.width, extent.height) == \
+        (8, 8, 16, 16)
+
+
+def test_preview_scale():
+    """
+    Tests that previews render sources at a fraction of their size.
+    """
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    _, _, width, height = builder.extent()
+
+    context = ontario.ImageContext(preview_scale=0.25)
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    builder.gaussian_blur(4, 4)
+    _, _, preview_width, preview_height = builder.extent()
+
+    assert abs(preview_width - width / 4) <= 2
+    assert abs(preview_height - height / 4) <= 2
+
+
+def test_preview_text():
+    """
+    Tests that previews keep unwrapped text on one line.
+    """
+
+    def extent(preview_scale):
+        context = ontario.ImageContext(preview_scale=preview_scale)
+        builder = ontario.ImageBuilder(context)
+        builder.text("Hello, preview", "Sans", 20.0, "black", -1, -1, 0, 0)
+        return builder.extent()
+
+    _, _, width, height = extent(1.0)
+    _, _, preview_width, preview_height = extent(0.5)
+    assert preview_height <= height / 2 + 2
+    assert preview_width >= width / 2 - 2
+
+
+def test_progress():
+    """
+    Tests that a stepwise render reports its progress.
+    """
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    builder.gaussian_blur(2, 2)
+
+    reported = []
+    builder.prerender(progress=reported.append)
+    assert reported
+    assert reported == sorted(reported)
+    assert reported[-1] == 1.0
+
+
+def test_cancel():
+    """
+    Tests that a cancelled render stops.
+    """
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    builder.gaussian_blur(2, 2)
+
+    token = ontario.CancellationToken()
+    token.cancel()
+    with pytest.raises(ontario.RenderCancelled):
+        builder.prerender(cancel=token)
+
+
+def test_save_to_file_progress():
+    """
+    Tests that saving to a file reports progress and can be cancelled.
+    """
+
+    with tempfile.TemporaryDirectory() as temp:
+        out = path.join(temp, "out.png")
+
+        context = ontario.ImageContext()
+        builder = ontario.ImageBuilder(context)
+        builder.load_from_file(TEST_IMAGE_PATH)
+        builder.gaussian_blur(2, 2)
+
+        reported = []
+        builder.save_to_file(out).process(progress=reported.append)
+        assert reported[-1] == 1.0
+        assert path.getsize(out) > 0
+
+        cancelled = path.join(temp, "cancelled.png")
+        builder = ontario.ImageBuilder(ontario.ImageContext())
+        builder.load_from_file(TEST_IMAGE_PATH)
+        token = ontario.CancellationToken()
+        token.cancel()
+        with pytest.raises(ontario.RenderCancelled):
+            builder.save_to_file(cancelled).process(cancel=token)
+        assert not path.exists(cancelled)
+
+
+def test_rewind_reuses_graph():
+    """
+    Tests that rebuilding a graph after rewind() reuses its nodes.
+    """
+
+    def build(context, std_dev):
+        builder = ontario.ImageBuilder(context)
+        builder.load_from_file(TEST_IMAGE_PATH)
+        builder.invert()
+        builder.gaussian_blur(std_dev, std_dev)
+        return builder
+
+    context = ontario.ImageContext()
+    build(context, 1.0).prerender()
+    children = len(context._parent.get_children())
+
+    context.rewind()
+    reused = build(context, 3.0).to_buffer()
+    context.trim()
+    assert len(context._parent.get_children()) == children
+
+    fresh = build(ontario.ImageContext(), 3.0).to_buffer()
+    rect = fresh.get_extent()
+    assert reused.get(rect, 1.0, "RGBA float",
+                      ontario.Gegl.AbyssPolicy.NONE) == \
+        fresh.get(rect, 1.0, "RGBA float", ontario.Gegl.AbyssPolicy.NONE)
+
+
+def test_to_buffer_leaves_graph_alone():
+    """
+    Tests that to_buffer() doesn't leave its sink in a replayed graph.
+    """
+
+    context = ontario.ImageContext()
+    for _ in range(3):
+        context.rewind()
+        builder = ontario.ImageBuilder(context)
+        builder.load_from_file(TEST_IMAGE_PATH)
+        builder.invert()
+        builder.to_buffer()
+        context.trim()
+
+        operations = [node.get_operation() for node in context._children]
+        assert "gegl:write-buffer" not in operations
+        assert len(context._parent.get_children()) == len(context._children)
+
+
+def test_save_to_bytes():
+    """
+    Tests encoding an image in memory.
+    """
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    builder.invert()
+
+    assert "png" in ontario.encodable_formats()
+    data = builder.save_to_bytes("png")
+    assert data.startswith(b"\x89PNG")
+
+    data = builder.save_to_bytes("jpg", quality=50)
+    assert data.startswith(b"\xff\xd8")
+
+    # webp comes from GdkPixbuf, or from GEGL through shared memory
+    if "webp" in ontario.encodable_formats():
+        data = builder.save_to_bytes("webp", quality=80)
+        assert data[:4] == b"RIFF" and data[8:12] == b"WEBP"
+
+        # Scratch files are removed once read back
+        if ontario._SCRATCH_DIR is not None:
+            prefix = f"{ontario._SCRATCH_PREFIX}{os.getpid()}-"
+            assert not any(
+                name.startswith(prefix)
+                for name in os.listdir(ontario._SCRATCH_DIR))
+
+    pixels = builder.to_buffer(format="R'G'B'A u8")
+    assert pixels.get_extent().width == builder.extent()[2]
+
+
+def test_image_size():
+    """
+    Tests reading the size of image files from their headers.
+    """
+
+    assert ontario.image_size(TEST_IMAGE_PATH) == (250, 250)
+
+    builder = ontario.ImageBuilder(ontario.ImageContext())
+    builder.load_from_file(TEST_IMAGE_PATH)
+    builder.crop(0, 0, 40, 30)
+    with tempfile.TemporaryDirectory() as temp:
+        for format in ("jpeg", "webp"):
+            if format not in ontario.encodable_formats():
+                continue
+            p = path.join(temp, f"cropped.{format}")
+            with open(p, "wb") as f:
+                f.write(builder.save_to_bytes(format))
+            assert ontario.image_size(p) == (40, 30)
+
+
+def test_numpy_round_trip():
+    """
+    Tests moving pixels between images and NumPy arrays.
+    """
+
+    numpy = pytest.importorskip("numpy")
+
+    pixels = numpy.zeros((8, 16, 4), dtype=numpy.float32)
+    pixels[:, :8, 0] = 1.0
+    pixels[..., 3] = 1.0
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_numpy(pixels)
+    assert numpy.array_equal(builder.to_numpy(), pixels)
+
+    builder.invert()
+    inverted = builder.to_numpy()
+    assert inverted.shape == (8, 16, 4)
+    assert numpy.allclose(inverted[..., :3], 1.0 - pixels[..., :3])
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    _, _, width, height = builder.extent()
+    assert builder.to_numpy("R'G'B' u8").shape == (height, width, 3)
+
+
+def test_flip():
+    """
+    Tests that flipping mirrors an image within its bounds.
+    """
+
+    numpy = pytest.importorskip("numpy")
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    original = builder.to_numpy()
+
+    builder.flip(True, False)
+    assert builder.extent() == builder.fork().flip(True, False).extent()
+    assert numpy.array_equal(builder.to_numpy(), original[:, ::-1])
+
+    builder.flip(True, True)
+    assert numpy.array_equal(builder.to_numpy(), original[::-1])
+
+
+def test_curves():
+    """
+    Tests the curves method.
+    """
+
+    numpy = pytest.importorskip("numpy")
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    original = builder.to_numpy()
+
+    builder.curves("0,0 1,1")
+    assert numpy.allclose(builder.to_numpy(), original, atol=1e-3)
+
+    # The curve works on gamma 2.2 encoded values, and leaves alpha alone.
+    builder.curves("0,1 0.5,0.25 1,0")
+    encoded = numpy.clip(original[..., :3], 0, 1) ** (1 / 2.2)
+    expected = numpy.interp(encoded, [0, 0.5, 1], [1, 0.25, 0]) ** 2.2
+    curved = builder.to_numpy()
+    assert numpy.allclose(curved[..., :3], expected, atol=1e-3)
+    assert numpy.allclose(curved[..., 3], original[..., 3], atol=1e-3)
+
+    # Nothing is rendered until the image is, so regions work as usual.
+    region = builder.to_numpy(rect=(0, 0, 8, 8))
+    assert numpy.allclose(region, curved[:8, :8], atol=1e-3)
+
+
+def test_perspective_transform():
+    """
+    Tests the perspective_transform method.
+    """
+
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+    builder.load_from_file(TEST_IMAGE_PATH)
+    x, y, width, height = builder.extent()
+
+    builder.perspective_transform(
+        x + 10, y, x + width - 10, y,
+        x + width, y + height, x, y + height)
+    builder.process()
+
+    new_x, new_y, new_width, new_height = builder.extent()
+    assert abs(new_x - x) <= 1 and abs(new_y - y) <= 1
+    assert abs(new_width - width) <= 1 and abs(new_height - height) <= 1
+
+
+def test_source_cache():
+    """
+    Tests that decoded files are reused until they change.
+    """
+
+    with tempfile.TemporaryDirectory() as temp:
+        copy = path.join(temp, "image.png")
+        shutil.copyfile(TEST_IMAGE_PATH, copy)
+
+        context = ontario.ImageContext()
+        first = ontario.ImageBuilder(context).load_from_file(copy)
+        assert copy in ontario.source_cache
+        size = ontario.source_cache.size()
+
+        second = ontario.ImageBuilder(context).load_from_file(copy)
+        assert ontario.source_cache.size() == size
+        assert first.extent() == second.extent()
+
+        # A replaced file is decoded again.
+        shutil.copyfile(TEST_IMAGE1_PATH, copy)
+        os.utime(copy, ns=(0, 0))
+        assert copy not in ontario.source_cache
+        ontario.ImageBuilder(context).load_from_file(copy).process()
+
+
+def test_load_sniffs_file_type():
+    """
+    Tests that files are loaded by content, whatever their extension.
+    """
+
+    with tempfile.TemporaryDirectory() as temp:
+        for name in ("image", "image.jpg", "image.."):
+            copy = path.join(temp, name)
+            shutil.copyfile(TEST_IMAGE_PATH, copy)
+
+            context = ontario.ImageContext()
+            builder = ontario.ImageBuilder(context)
+            builder.load_from_file(copy, cache=False)
+            assert builder.extent()[2] > 0
+            builder.process()
+
+
+def test_load_svg():
+    """
+    Tests loading an SVG file.
+    """
+
+    with tempfile.TemporaryDirectory() as temp:
+        svg = path.join(temp, "image.svg")
+        with open(svg, "w") as f:
+            f.write(
+                '<svg xmlns="http://www.w3.org/2000/svg" width="32" '
+                'height="16"><rect width="32" height="16" fill="red"/></svg>')
+
+        context = ontario.ImageContext()
+        builder = ontario.ImageBuilder(context)
+        builder.load_from_file(svg)
+        assert builder.extent()[2:] == (32, 16)
+
+
+def test_configure():
+    """
+    Tests tuning GEGL.
+    """
+
+    config = ontario.Gegl.config()
+    threads = config.get_property("threads")
+
+    ontario.configure(threads=2)
+    assert config.get_property("threads") == 2
+
+    ontario.configure(threads=threads)
+    assert config.get_property("threads") == threads
+
+
+def test_context_manager():
+    """
+    Tests that closing a context empties it and its builders.
+    """
+
+    with ontario.ImageContext() as context:
+        builder = ontario.ImageBuilder(context)
+        builder.load_from_file(TEST_IMAGE_PATH)
+        builder.invert()
+        builder.process()
+        assert context._parent.get_children()
+
+    assert not context._parent.get_children()
+    assert builder.is_empty()
@@ -0,0 +1,87 @@
+#  GNU AGPL v3 License
+
+import os
+
+import pytest
+
+import ontario
+
+# Thousands of renders take minutes, so these only run when asked for, with
+# scripts/pytest_soak.sh or ONTARIO_SOAK=1.
+pytestmark = [
+    pytest.mark.skipif(
+        os.environ.get("ONTARIO_SOAK") != "1",
+        reason="set ONTARIO_SOAK=1 to run soak tests"),
+    pytest.mark.skipif(
+        not os.path.exists("/proc/self/statm"), reason="needs /proc"),
+]
+
+RENDERS = 10000
+
+# How much the resident set may grow once the caches have warmed up.
+MAX_GROWTH = 16 * 1024 * 1024
+
+
+def resident_set_size():
+    """
+    Returns the current resident set size of this process, in bytes.
+    """
+
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def render(source):
+    with ontario.ImageContext() as context:
+        builder = ontario.ImageBuilder(context)
+        builder.load_from_buffer(source)
+        builder.invert()
+        builder.brightness_contrast(0.1, 1.2)
+        builder.to_buffer()
+
+
+def test_renders_do_not_leak():
+    """
+    Tests that memory stays flat over many successive renders.
+    """
+
+    source = ontario.Gegl.Buffer.new("RGBA float", 0, 0, 64, 64)
+
+    for _ in range(RENDERS // 10):
+        render(source)
+    before = resident_set_size()
+
+    for _ in range(RENDERS):
+        render(source)
+    after = resident_set_size()
+
+    assert after - before < MAX_GROWTH
+
+
+def test_reset_context_does_not_leak():
+    """
+    Tests that refilling one long-lived context, like the GIMP plugin does,
+    keeps memory flat.
+    """
+
+    source = ontario.Gegl.Buffer.new("RGBA float", 0, 0, 64, 64)
+    context = ontario.ImageContext()
+    builder = ontario.ImageBuilder(context)
+
+    def refill():
+        context.reset_context()
+        builder.load_from_buffer(source)
+        builder.invert()
+        builder.to_buffer()
+
+    for _ in range(RENDERS // 10):
+        refill()
+    before = resident_set_size()
+
+    for _ in range(RENDERS):
+        refill()
+    after = resident_set_size()
+
+    assert after - before < MAX_GROWTH
+    assert len(context._parent.get_children()) == 2
@@ -1375,6 +1375,10 @@ class WaterpixelNode(CustomNode):
         # busy box
         self.busy_box = None
 
+        # the running render, so a newer one can cancel it
+        self.render_thread = None
+        self.render_token = None
+
         self.dot_count = 4
 
         # add argument fields
@@ -1441,7 +1445,7 @@ class WaterpixelNode(CustomNode):
         self.entry2.set_text(str(self.smoothness))
         self.entry3.set_text(str(self.regularization))
 
-    def process_input(self):
+    def process_input(self, cancel, previous_thread):
 
         def increment_spinner():
             try:
@@ -1469,15 +1473,34 @@ class WaterpixelNode(CustomNode):
             self.busy_box = None
             return False
 
+        def show_progress(done):
+            GLib.idle_add(update_progress, done)
+
+        def update_progress(done):
+            if self.busy_box:
+                self.busy_box.set_message(f"Processing {int(done * 100)}%")
+            return False
+
+        # let the render this one replaces stop before touching the graph
+        if previous_thread:
+            previous_thread.join()
+        if cancel.is_cancelled():
+            return
+
         GLib.idle_add(add_spinner)
         # set internal copy of buffer
-        self.buffer = self.incoming_buffer.dup()
+        buffer = self.incoming_buffer.dup()
 
         # use ontario backend for image processing
-        self.image_builder.load_from_buffer(self.buffer)
+        self.image_builder.load_from_buffer(buffer)
         self.image_builder.waterpixels(self.size, self.smoothness, self.regularization)
-        self.image_builder.save_to_buffer(self.buffer)
-        self.image_builder.process()
+        self.image_builder.save_to_buffer(buffer)
+        try:
+            self.image_builder.process(progress=show_progress, cancel=cancel)
+        except ontario.RenderCancelled:
+            # a newer render is on its way, and will remove the spinner
+            return
+        self.buffer = buffer
 
         # update buffer saved in map and resend reference
         self.value_update()
@@ -1485,8 +1508,16 @@ class WaterpixelNode(CustomNode):
 
     def process_handler(self):
         if self.incoming_buffer:
+            # stop a render whose values are out of date
+            if self.render_token:
+                self.render_token.cancel()
+            self.render_token = ontario.CancellationToken()
+
             # process image manip on new thread
-            process_thread = threading.Thread(target=self.process_input)
+            process_thread = threading.Thread(
+                target=self.process_input,
+                args=(self.render_token, self.render_thread))
+            self.render_thread = process_thread
             process_thread.start()
         else:
             # update buffer saved in map and resend reference
@@ -1629,6 +1660,10 @@ class TileGlassNode(CustomNode):
         self.busy_box = None
         self.dot_count = 4
 
+        # the running render, so a newer one can cancel it
+        self.render_thread = None
+        self.render_token = None
+
         # add argument fields
         self.label1 = Gtk.Label(label="Tile Width")
         self.label2 = Gtk.Label(label="Tile Height")
@@ -1684,7 +1719,7 @@ class TileGlassNode(CustomNode):
         self.entry1.set_text(str(self.width))
         self.entry2.set_text(str(self.height))
 
-    def process_input(self):
+    def process_input(self, cancel, previous_thread):
 
         def increment_spinner():
             try:
@@ -1712,15 +1747,34 @@ class TileGlassNode(CustomNode):
             self.busy_box = None
             return False
 
+        def show_progress(done):
+            GLib.idle_add(update_progress, done)
+
+        def update_progress(done):
+            if self.busy_box:
+                self.busy_box.set_message(f"Processing {int(done * 100)}%")
+            return False
+
+        # let the render this one replaces stop before touching the graph
+        if previous_thread:
+            previous_thread.join()
+        if cancel.is_cancelled():
+            return
+
         GLib.idle_add(add_spinner)
         # set internal copy of buffer
-        self.buffer = self.incoming_buffer.dup()
+        buffer = self.incoming_buffer.dup()
 
         # use ontario backend for image processing
-        self.image_builder.load_from_buffer(self.buffer)
+        self.image_builder.load_from_buffer(buffer)
         self.image_builder.tileglass(self.width, self.height)
-        self.image_builder.save_to_buffer(self.buffer)
-        self.image_builder.process()
+        self.image_builder.save_to_buffer(buffer)
+        try:
+            self.image_builder.process(progress=show_progress, cancel=cancel)
+        except ontario.RenderCancelled:
+            # a newer render is on its way, and will remove the spinner
+            return
+        self.buffer = buffer
 
         # update buffer saved in map and resend reference
         self.value_update()
@@ -1728,8 +1782,16 @@ class TileGlassNode(CustomNode):
 
     def process_handler(self):
         if self.incoming_buffer:
+            # stop a render whose values are out of date
+            if self.render_token:
+                self.render_token.cancel()
+            self.render_token = ontario.CancellationToken()
+
             # process image manip on new thread
-            process_thread = threading.Thread(target=self.process_input)
+            process_thread = threading.Thread(
+                target=self.process_input,
+                args=(self.render_token, self.render_thread))
+            self.render_thread = process_thread
             process_thread.start()
         else:
             # update buffer saved in map and resend reference
@@ -0,0 +1,18 @@
+#!/bin/bash
+# GNU AGPL v3 License
+
+# Runs the soak tests, which render thousands of images to check that memory
+# stays flat, in the Python projects that have them
+set -ex
+PY_PROJECTS=(
+  "backend/ontario"
+  "backend/ontario-web"
+)
+
+for project in "${PY_PROJECTS[@]}"
+do
+  echo "Running soak tests on $project"
+  pushd $project
+  ONTARIO_SOAK=1 pytest tests/test_soak.py
+  popd
+done